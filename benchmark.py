@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+"""Benchmarks of roam-to-git on synthetic Roam graphs.
+
+Run it with `./benchmark.py`, see `./benchmark.py --help` for the size and the shape of the
+graph. It reports the throughput and the memory of each stage of the pipeline, and compares the
+optimized functions with their previous version.
+For a graph with long daily notes linking to a few hub pages:
+`./benchmark.py --pages 200 --blocks 1000 --hubs 5`
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from itertools import takewhile
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import git
+from loguru import logger
+
+from roam_to_git.formatter import Link, MarkdownDirectory, build_note_index, extract_links, \
+    extract_note_links, format_link, format_markdown, format_to_do, get_back_links, \
+    get_link_contexts, iter_format_markdown, iter_markdown_files, read_markdown_directory, \
+    _format_and_extract_links
+from roam_to_git.fs import JET_COMMAND, DirectoryWriter, commit_git_directory, pretty_print_edn, \
+    reset_git_directory, save_file, save_files, save_json_archive, unzip_archive, _run_jet
+from roam_to_git.search import search_notes, update_search_index
+
+
+def generate_graph(n_pages: int, n_blocks: int = 20, links_per_block: float = 1.,
+                   n_hubs: int = 0, hub_probability: float = .5, namespaces: float = 0.,
+                   emojis: float = 0., seed: int = 0) -> Dict[str, str]:
+    """Generate the markdown export of a random graph
+
+    :param n_hubs: number of pages receiving a large part of the links, like the pages of
+        projects or people linked from the daily notes.
+    :param hub_probability: probability that a link goes to a hub page
+    :param namespaces: fraction of the pages in a namespace, like "Project/Meeting", that
+        Roam exports in a sub-directory
+    :param emojis: probability that a block ends with an emoji, a character that makes Python
+        store the whole note with 4 bytes per character
+    """
+    rng = random.Random(seed)
+    names = [f"Project {rng.randrange(10)}/Page {i}" if rng.random() < namespaces
+             else f"Page {i}" for i in range(n_pages)]
+    hubs = names[:n_hubs]
+    contents = {}
+    for name in names:
+        lines = []
+        for _ in range(n_blocks):
+            words = [rng.choice(["lorem", "ipsum", "dolor", "sit", "amet"])
+                     for _ in range(rng.randint(5, 20))]
+            n_links = int(links_per_block) + (rng.random() < links_per_block % 1)
+            for _ in range(n_links):
+                kind = rng.random()
+                if hubs and kind < hub_probability:
+                    link = f"[[{rng.choice(hubs)}]]"
+                elif kind < .7:
+                    link = f"[[{rng.choice(names)}]]"
+                else:
+                    link = f"#tag{rng.randrange(n_pages)}"
+                words.insert(rng.randrange(len(words) + 1), link)
+            line = " ".join(words)
+            kind = rng.random()
+            if kind < .1:
+                line = f"{{{{[[TODO]]}}}} {line}"
+            elif kind < .15:
+                line = f"{{{{[[DONE]]}}}} {line}"
+            elif kind < .25:
+                line = f"attribute {rng.randrange(10)}:: {line}"
+            if rng.random() < emojis:
+                line = f"{line} \U0001f600"
+            lines.append(f"{'  ' * rng.randrange(3)}- {line}")
+        contents[f"{name}.md"] = "\n".join(lines) + "\n"
+    return contents
+
+
+def measure(name: str, function: Callable[[], object], repeat: int = 3) -> float:
+    """Print and return the best wall time of a function"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<40} {best * 1000:10.1f} ms")
+    return best
+
+
+def measure_throughput(name: str, function: Callable[[], object], n_pages: int, size: int,
+                       repeat: int = 3):
+    """Print the best wall time, the throughput and the peak of memory of a function"""
+    best = measure(name, function, repeat=repeat)
+    print(f"{'':<40} {n_pages / best:10.0f} pages/s {size / best / 1e6:8.1f} MB/s")
+    measure_memory(f"{name} memory", function)
+
+
+def measure_memory(name: str, function: Callable[[], object]) -> int:
+    """Print and return the peak of memory allocated by a function"""
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    print(f"{name:<40} {peak / 1e6:10.1f} MB")
+    return peak
+
+
+def generate_json_export(contents: Dict[str, str]) -> str:
+    """Generate a Roam JSON export from a markdown graph, with one block per line"""
+    pages = []
+    for i, (file_name, content) in enumerate(contents.items()):
+        page: Dict[str, Any] = {"title": file_name[:-3], "children": [],
+                                "create-time": 1600000000000, "edit-time": 1600000000000}
+        # Parents of the current block, by indentation level
+        parents = [page]
+        for j, line in enumerate(content.splitlines()):
+            depth = min((len(line) - len(line.lstrip())) // 2 + 1, len(parents))
+            block = {"string": line.strip()[2:], "uid": f"{i}-{j}", "create-time": 1600000000000,
+                     "edit-time": 1600000000000, "create-email": "me@example.com",
+                     ":block/refs": [{":block/uid": f"{i}-{k}"} for k in range(j % 3)]}
+            parents[depth - 1].setdefault("children", []).append(block)
+            parents[depth:] = [block]
+        pages.append(page)
+    return json.dumps(pages)
+
+
+def bench_json(contents: Dict[str, str]):
+    """Compare saving the JSON export as a single file and as one file per page"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory)
+        (path / "zip").mkdir()
+        export = generate_json_export(contents)
+        print(f"JSON export of {len(export) / 1e6:.1f} MB")
+        with zipfile.ZipFile(path / "zip" / "export.zip", "w") as zip_file:
+            zip_file.writestr("export.json", export)
+        del export
+
+        def single_file():
+            content, = unzip_archive(path / "zip").values()
+            with (path / "export.json").open("w", encoding="utf-8") as f:
+                json.dump(json.loads(content), f, sort_keys=True, indent=2, ensure_ascii=True)
+
+        def one_file_per_page():
+            save_json_archive(path / "zip", DirectoryWriter(path / "json"))
+
+        before = measure("json, single file", single_file, repeat=1)
+        after = measure("json, one file per page", one_file_per_page, repeat=1)
+        print(f"{'speedup':<40} {before / after:10.2f} x")
+        shutil.rmtree(path / "json")
+        before = measure_memory("json memory, single file", single_file)
+        after = measure_memory("json memory, one file per page", one_file_per_page)
+        print(f"{'memory reduction':<40} {before / after:10.2f} x")
+
+
+def bench_formatter(contents: Dict[str, str], jobs: int):
+    """Compare the single-pass scanner with the regexes applied one after the other"""
+    def multi_pass():
+        for content in contents.values():
+            extract_links(content)
+            format_link(format_to_do(content), link_prefix="../")
+
+    def single_pass():
+        for content in contents.values():
+            _format_and_extract_links(content, link_prefix="../")
+
+    before = measure("format notes, one regex at a time", multi_pass)
+    after = measure("format notes, single pass", single_pass)
+    print(f"{'speedup':<40} {before / after:10.2f} x")
+    measure("format_markdown", lambda: format_markdown(contents))
+    if jobs > 1:
+        measure(f"format_markdown, {jobs} jobs", lambda: format_markdown(contents, jobs=jobs))
+
+
+def _previous_link_contexts(content: str, links: List[Link]) -> List[str]:
+    """Context extraction before it used the positions of the line breaks"""
+    contexts = []
+    for link in links:
+        start_context = "".join(list(takewhile(lambda c: c != "\n",
+                                               content[:link.start][::-1]))[::-1])
+        end_context = "".join(takewhile(lambda c: c != "\n", content[link.end:link.end + 1]))
+        contexts.append((start_context + content[link.start:link.end] + end_context).strip())
+    return contexts
+
+
+def bench_low_memory(contents: Dict[str, str]):
+    """Compare the formatting of a markdown directory with and without keeping the notes"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory)
+        save_files("markdown", path / "markdown", contents)
+
+        def format_directory(low_memory: bool):
+            def run():
+                notes = MarkdownDirectory(path / "markdown")
+                for _ in iter_format_markdown(notes, low_memory=low_memory):
+                    pass
+            return run
+
+        measure("format directory", format_directory(False), repeat=1)
+        measure("format directory, low memory", format_directory(True), repeat=1)
+        before = measure_memory("format directory memory", format_directory(False))
+        after = measure_memory("format directory memory, low memory", format_directory(True))
+        print(f"{'memory reduction':<40} {before / after:10.2f} x")
+
+
+def bench_back_links(contents: Dict[str, str]):
+    """Compare the context extraction of the backlinks"""
+    links = {file_name: extract_note_links(content) for file_name, content in contents.items()}
+    n_links = sum(len(note_links) for note_links in links.values())
+    print(f"{n_links} links")
+
+    def contexts(function):
+        return lambda: [function(content, links[file_name])
+                        for file_name, content in contents.items()]
+
+    before = measure("backlink contexts, reversed prefix", contexts(_previous_link_contexts))
+    after = measure("backlink contexts, line offsets", contexts(get_link_contexts))
+    print(f"{'speedup':<40} {before / after:10.2f} x")
+    measure("get_back_links", lambda: get_back_links(contents))
+
+
+def bench_edn(contents: Dict[str, str], n_documents: int):
+    """Compare one jet process per EDN file with a single jet process for all of them"""
+    if shutil.which(JET_COMMAND[0]) is None:
+        print("jet is not installed, skipping the EDN benchmark")
+        return
+    documents = [
+        "[" + " ".join(f'{{:node/title "{file_name[:-3]}" :block/string {json.dumps(content)}}}'
+                       for file_name, content in list(contents.items())[i::n_documents]) + "]"
+        for i in range(n_documents)]
+
+    before = measure(f"{n_documents} EDN files, one jet per file",
+                     lambda: [_run_jet(document) for document in documents], repeat=1)
+    after = measure(f"{n_documents} EDN files, one jet for all",
+                    lambda: pretty_print_edn(documents), repeat=1)
+    print(f"{'speedup':<40} {before / after:10.2f} x")
+
+
+def bench_pipeline(contents: Dict[str, str]):
+    """Run roam-to-git on a local markdown archive, without browser nor git"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory)
+        with zipfile.ZipFile(path / "markdown.zip", "w") as zip_file:
+            for file_name, content in contents.items():
+                zip_file.writestr(file_name, content)
+        command = [sys.executable, "-m", "roam_to_git", str(path / "notes"), "--skip-git",
+                   "--from-archive", str(path / "markdown.zip"), "-f", "markdown", "formatted"]
+
+        def run():
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+
+        measure("roam-to-git, first run", run, repeat=1)
+        measure("roam-to-git, no change", run)
+
+
+def bench_commit(contents: Dict[str, str], n_changes: int = 10):
+    """Compare committing the whole working tree with committing only the notes directory"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory)
+        repo = git.Repo.init(path)
+        with repo.config_writer() as config:
+            config.set_value("user", "name", "benchmark")
+            config.set_value("user", "email", "benchmark@example.com")
+        writer = DirectoryWriter(path / "markdown")
+        for file_name, content in contents.items():
+            writer.save("markdown", file_name, content)
+        commit_git_directory(repo, [writer.directory])
+
+        changes = iter(range(10 ** 9))
+
+        def commit(whole_tree: bool):
+            writer = DirectoryWriter(path / "markdown")
+            for file_name in list(contents)[:n_changes]:
+                writer.save("markdown", file_name, f"change {next(changes)}")
+            commit_git_directory(repo, None if whole_tree else [writer.directory])
+
+        before = measure(f"commit {n_changes} files, whole tree", lambda: commit(True))
+        after = measure(f"commit {n_changes} files, notes directory", lambda: commit(False))
+        print(f"{'speedup':<40} {before / after:10.2f} x")
+
+
+def bench_search(contents: Dict[str, str], n_changes: int = 10):
+    """Build and update the search index, and compare a query with a scan of the notes"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory)
+        save_files("markdown", path / "markdown", contents)
+        notes = MarkdownDirectory(path / "markdown")
+        index = build_note_index(notes)
+
+        def build():
+            if (path / "search.sqlite").exists():
+                (path / "search.sqlite").unlink()
+            update_search_index(path / "search.sqlite", notes, index)
+
+        measure("build search index", build, repeat=1)
+        print(f"{'search index size':<40} {(path / 'search.sqlite').stat().st_size / 1e6:10.1f} MB")
+        changes = iter(range(10 ** 9))
+
+        def update():
+            changed = dict(index)
+            for file_name in list(contents)[:n_changes]:
+                changed[file_name] = (f"change {next(changes)}", [])
+            update_search_index(path / "search.sqlite", notes, changed)
+
+        measure(f"update search index, {n_changes} notes", update)
+        word = contents[next(iter(contents))].split()[-1].strip("#[]")
+
+        def scan():
+            # Like grep on the markdown directory
+            pattern = re.compile(re.escape(word), flags=re.IGNORECASE)
+            return [file_name for file_name, file in iter_markdown_files(path / "markdown")
+                    if pattern.search(file.read_text(encoding="utf-8"))]
+
+        before = measure(f"scan the notes for '{word}'", scan)
+        after = measure(f"search the index for '{word}'",
+                        lambda: search_notes(path / "search.sqlite", word, limit=len(contents)))
+        print(f"{'speedup':<40} {before / after:10.2f} x")
+
+
+_FORMAT_DIRECTORY_SCRIPT = """
+import resource, sys, time
+from pathlib import Path
+from roam_to_git.formatter import MarkdownDirectory, iter_format_markdown
+notes = MarkdownDirectory(Path(sys.argv[1]))
+start = time.process_time()
+for _ in iter_format_markdown(notes, memory_map=sys.argv[2] == "1"):
+    pass
+print(time.process_time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def bench_memory_map(contents: Dict[str, str]):
+    """Compare the peak of resident memory and the CPU time of the formatting of a markdown
+    directory, with the notes read as str and mapped in memory as bytes"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory)
+        save_files("markdown", path / "markdown", contents)
+        results = {}
+        for memory_map in [False, True]:
+            # Each one in a new process, for its own peak of memory
+            runs = [subprocess.run([sys.executable, "-c", _FORMAT_DIRECTORY_SCRIPT,
+                                    str(path / "markdown"), str(int(memory_map))],
+                                   stdout=subprocess.PIPE, check=True).stdout.split()
+                    for _ in range(3)]
+            cpu = min(float(run[0]) for run in runs)
+            rss = min(int(run[1]) * 1024 for run in runs)
+            name = "memory map" if memory_map else "str"
+            print(f"{'format directory CPU, ' + name:<40} {cpu * 1000:10.1f} ms")
+            print(f"{'format directory peak RSS, ' + name:<40} {rss / 1e6:10.1f} MB")
+            results[memory_map] = cpu, rss
+        print(f"{'CPU reduction':<40} {results[False][0] / results[True][0]:10.2f} x")
+        print(f"{'memory reduction':<40} {results[False][1] / results[True][1]:10.2f} x")
+
+
+def bench_write_threads(contents: Dict[str, str]):
+    """Compare the serial save_file loop with the writes in a pool of threads"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory)
+
+        def serial():
+            shutil.rmtree(path / "saved", ignore_errors=True)
+            for file_name, content in contents.items():
+                save_file("markdown", path / "saved", file_name, content)
+
+        def threaded(workers: int):
+            def run():
+                shutil.rmtree(path / "saved", ignore_errors=True)
+                save_files("markdown", path / "saved", contents, workers=workers)
+            return run
+
+        before = measure("save_file loop", serial)
+        for workers in [1, 4, 16]:
+            after = measure(f"save_files, {workers} threads", threaded(workers))
+            print(f"{'speedup':<40} {before / after:10.2f} x")
+
+
+def _previous_reset_git_directory(git_path: Path, skip=(".git",)):
+    """reset_git_directory before it used walk_directory"""
+    to_remove: List[Path] = []
+    for file in git_path.glob("**/*"):
+        if any(skip_item in file.parts for skip_item in skip):
+            continue
+        to_remove.append(file)
+    to_remove = sorted(set(to_remove))[::-1]
+    for file in to_remove:
+        if file.is_file():
+            file.unlink()
+        elif file.is_dir():
+            if not list(file.iterdir()):
+                file.rmdir()
+
+
+def _previous_iter_markdown_files(raw_directory: Path) -> Iterator[Tuple[str, Path]]:
+    """iter_markdown_files before it used walk_directory"""
+    directories = [(raw_directory, "")]
+    while directories:
+        directory, prefix = directories.pop()
+        sub_directories = []
+        for file in directory.iterdir():
+            if file.is_dir():
+                sub_directories.append((file, f"{prefix}{file.name}/"))
+            elif file.is_file():
+                yield f"{prefix}{file.name}", file
+        directories.extend(reversed(sub_directories))
+
+
+def bench_walk(n_files: int):
+    """Compare the scans of a large tree with pathlib and with walk_directory"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory)
+
+        def create_tree():
+            # Like a repository: 100 files per directory, and a .git directory
+            for i in range(n_files):
+                file = path / "tree" / f"dir{i // 100}" / f"page{i}.md"
+                if i % 100 == 0:
+                    file.parent.mkdir(parents=True)
+                file.write_bytes(b"")
+            for i in range(n_files // 10):
+                file = path / "tree" / ".git" / "objects" / f"{i // 100:02x}" / f"{i:038x}"
+                if i % 100 == 0:
+                    file.parent.mkdir(parents=True)
+                file.write_bytes(b"")
+
+        create_tree()
+        print(f"Tree of {n_files} files")
+        before = measure("iter_markdown_files, pathlib",
+                         lambda: list(_previous_iter_markdown_files(path / "tree")))
+        after = measure("iter_markdown_files, scandir",
+                        lambda: list(iter_markdown_files(path / "tree")))
+        print(f"{'speedup':<40} {before / after:10.2f} x")
+
+        def reset(function: Callable[[Path], None]) -> float:
+            # The tree is created again before each reset, without measuring it
+            best = float("inf")
+            for _ in range(3):
+                if not (path / "tree" / "dir0").exists():
+                    shutil.rmtree(path / "tree")
+                    create_tree()
+                start = time.perf_counter()
+                function(path / "tree")
+                best = min(best, time.perf_counter() - start)
+            return best
+
+        before = reset(_previous_reset_git_directory)
+        print(f"{'reset_git_directory, pathlib':<40} {before * 1000:10.1f} ms")
+        after = reset(reset_git_directory)
+        print(f"{'reset_git_directory, scandir':<40} {after * 1000:10.1f} ms")
+        print(f"{'speedup':<40} {before / after:10.2f} x")
+
+
+def measure_import(module: str, repeat: int = 5) -> Dict[str, float]:
+    """Return the best cumulative import time of a module and of its imports, in seconds, in a
+    new interpreter with `python -X importtime`"""
+    best: Dict[str, float] = {}
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                stderr=subprocess.PIPE, check=True).stderr.decode()
+        times: Dict[str, float] = {}
+        for line in output.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line[len("import time:"):].split("|")
+            times[name.strip()] = int(cumulative) / 1e6
+        for name, duration in times.items():
+            best[name] = min(best.get(name, float("inf")), duration)
+    return best
+
+
+def bench_import():
+    """Import time of the command line, and of the modules only imported by some stages"""
+    times = measure_import("roam_to_git.__main__")
+    print(f"{'import roam_to_git.__main__':<40} {times['roam_to_git.__main__'] * 1000:10.1f} ms")
+    for module in ["git", "selenium", "psutil", "pdb"]:
+        loaded = "loaded" if module in times else "not loaded"
+        print(f"{'  ' + module:<40} {loaded:>10}")
+    for module in ["roam_to_git.scrapping", "git", "psutil"]:
+        print(f"{'import ' + module:<40} {measure_import(module)[module] * 1000:10.1f} ms")
+
+
+def write_markdown_archive(contents: Dict[str, str], zip_path: Path):
+    """Write a graph like the markdown archive exported by Roam"""
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for file_name, content in contents.items():
+            zip_file.writestr(file_name, content)
+
+
+def bench_stages(contents: Dict[str, str]):
+    """Throughput and memory of each stage of the pipeline on a markdown archive"""
+    n_pages = len(contents)
+    size = sum(len(content.encode()) for content in contents.values())
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory)
+        (path / "zip").mkdir()
+        write_markdown_archive(contents, path / "zip" / "markdown.zip")
+        print(f"Markdown archive of {(path / 'zip' / 'markdown.zip').stat().st_size / 1e6:.1f} MB")
+
+        measure_throughput("unzip_archive", lambda: unzip_archive(path / "zip"), n_pages, size)
+        save_files("markdown", path / "markdown", contents)
+        measure_throughput("read_markdown_directory",
+                           lambda: read_markdown_directory(path / "markdown"), n_pages, size)
+        measure_throughput("get_back_links", lambda: get_back_links(contents), n_pages, size)
+        measure_throughput("format_markdown", lambda: format_markdown(contents), n_pages, size,
+                           repeat=1)
+        measure_throughput("save_files", lambda: save_files("markdown", path / "saved", contents),
+                           n_pages, size)
+
+        # The files are saved again before each reset, without measuring it
+        best = float("inf")
+        for _ in range(3):
+            save_files("markdown", path / "saved", contents)
+            start = time.perf_counter()
+            reset_git_directory(path / "saved")
+            best = min(best, time.perf_counter() - start)
+        print(f"{'reset_git_directory':<40} {best * 1000:10.1f} ms")
+        print(f"{'':<40} {n_pages / best:10.0f} pages/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=5000, help="Number of pages of the graph")
+    parser.add_argument("--blocks", type=int, default=20, help="Number of blocks per page")
+    parser.add_argument("--links-per-block", type=float, default=1.,
+                        help="Average number of links and hashtags per block")
+    parser.add_argument("--hubs", type=int, default=0,
+                        help="Number of hub pages, receiving a large part of the links")
+    parser.add_argument("--namespaces", type=float, default=.1,
+                        help="Fraction of the pages in a namespace, saved in a sub-directory")
+    parser.add_argument("--emojis", type=float, default=.05,
+                        help="Probability that a block ends with an emoji, for the benchmark "
+                             "of the notes mapped in memory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--edn-documents", type=int, default=100,
+                        help="Number of EDN files to pretty print with jet")
+    parser.add_argument("--walk-files", type=int, default=100000,
+                        help="Number of files of the tree scanned by the walk benchmark")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of processes for the parallel formatting")
+    args = parser.parse_args()
+    # The debug logs of roam-to-git would be mixed with the results
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+
+    contents = generate_graph(args.pages, n_blocks=args.blocks,
+                              links_per_block=args.links_per_block, n_hubs=args.hubs,
+                              namespaces=args.namespaces, seed=args.seed)
+    size = sum(len(content) for content in contents.values())
+    print(f"Graph of {len(contents)} pages, {size / 1e6:.1f} MB")
+    bench_import()
+    bench_stages(contents)
+    bench_write_threads(contents)
+    bench_walk(args.walk_files)
+    bench_formatter(contents, jobs=args.jobs)
+    bench_back_links(contents)
+    bench_low_memory(contents)
+    bench_memory_map(generate_graph(args.pages, n_blocks=args.blocks,
+                                    links_per_block=args.links_per_block, n_hubs=args.hubs,
+                                    namespaces=args.namespaces, emojis=args.emojis,
+                                    seed=args.seed))
+    bench_edn(contents, args.edn_documents)
+    bench_json(contents)
+    bench_pipeline(contents)
+    bench_commit(contents)
+    bench_search(contents)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,40 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import queue
+import shutil
+import signal
 import sys
+import tempfile
+import threading
 import time
-import shutil
 from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
-import git
 from dotenv import load_dotenv
 from loguru import logger
 
-from roam_to_git.formatter import read_markdown_directory, format_markdown
-from roam_to_git.fs import reset_git_directory, save_files, unzip_and_save_archive, \
-    commit_git_directory, push_git_repository, create_temporary_directory
-from roam_to_git.scrapping import scrap, Config, ROAM_FORMATS
+from roam_to_git.exporter import ROAM_FORMATS, Exporter, LocalExporter, _kill_child_process
+from roam_to_git.formatter import INDEX_VERSION, MarkdownDirectory, NoteIndex, \
+    build_note_index, iter_format_markdown, format_markdown_incremental, read_note_index, \
+    save_note_index
+from roam_to_git.fs import DirectoryWriter, unzip_and_save_archive, \
+    save_edn_directory, save_json_archive, commit_git_directory, push_git_repository, \
+    is_push_due, create_temporary_directory, get_archive_members, read_archive_cache, \
+    save_archive_cache
+from roam_to_git.metrics import Metrics
+from roam_to_git.search import update_search_index
+
+# The modules of the stages that need a browser or a repository are imported by these stages,
+# so the runs that only format the notes start faster
+if TYPE_CHECKING:
+    import git
 
 CUSTOM_FORMATS = ("formatted",)
 ALL_FORMATS = ROAM_FORMATS + CUSTOM_FORMATS
 DEFAULT_FORMATS = ROAM_FORMATS[:2] + CUSTOM_FORMATS  # exclude EDN from default formats
+# Directory of the notes repository where roam-to-git keeps its state between runs
+STATE_DIRECTORY = ".roam-to-git"
 
 
 # https://stackoverflow.com/a/41153081/3262054
@@ -49,21 +66,75 @@ def main():
                              "git-related action.")
     parser.add_argument("--skip-push", action="store_true",
                         help="Don't git push after commit.")
+    parser.add_argument("--push-every", type=int, default=1,
+                        help="Only push once there are this number of commits to push.")
+    parser.add_argument("--push-interval", type=float, default=None,
+                        help="With --push-every, also push when the oldest commit to push is "
+                             "older than this number of seconds.")
+    parser.add_argument("--push-retries", type=int, default=3,
+                        help="Number of times a failed push is retried, with an exponential "
+                             "backoff.")
     parser.add_argument("--sleep-duration", type=float, default=2.,
-                        help="Duration to wait for the interface. We wait 100x that duration for"
-                             "Roam to load. Increase it if Roam servers are slow, but be careful"
-                             "with the free tier of Github Actions.")
+                        help="Duration to wait for the interface. We wait up to 100x that"
+                             " duration for Roam to load. Increase it if Roam servers are slow,"
+                             " but be careful with the free tier of Github Actions.")
     parser.add_argument("--browser", default="firefox",
                         help="Browser to use for scrapping in Selenium.")
     parser.add_argument("--browser-arg",
                         help="Flags to pass through to launched browser.",
                         action='append')
+    parser.add_argument("--browser-profile",
+                        help="Directory of a persistent browser profile, to keep the Roam session "
+                             "between the runs and only sign-in when it's expired. Don't put it "
+                             "in the notes repository, it contains your session.")
+    parser.add_argument("--from-archive", action="append",
+                        help="Import an archive previously exported from Roam, instead of "
+                             "downloading it with a browser. The zip files downloaded from Roam "
+                             "and the JSON or EDN files they contain are supported. Repeat it "
+                             "for each format.")
     parser.add_argument("--formats", "-f", action=ExtendAction, nargs="+", type=str,
                         help="Which formats to save. Options include json, markdown, formatted, "
                              "and edn. Note that if only formatted is specified, the markdown "
                              "directory will be converted to a formatted directory skipping "
                              "fetching entirely. Also note that if jet is installed, the edn "
                              "output will be pretty printed allowing for cleaner git diffs.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only re-format the notes impacted by the changes since the last "
+                             "run, using the link graph of the notes saved in "
+                             ".roam-to-git/links.jsonl in the repository.")
+    parser.add_argument("--low-memory", action="store_true",
+                        help="Don't keep all the formatted notes in memory while building their "
+                             "Backlinks section. The notes are read twice, but the memory only "
+                             "depends on the number of links, for large graphs on small "
+                             "machines.")
+    parser.add_argument("--memory-map", action="store_true",
+                        help="Read the notes as bytes, mapping the large ones in memory, and "
+                             "keep them in UTF-8 while formatting them. It takes less memory "
+                             "for the notes with non-ASCII characters, like emojis.")
+    parser.add_argument("--write-threads", type=int, default=1,
+                        help="Number of threads writing the files in the repository. Writing "
+                             "in parallel is faster on network file systems, where each file "
+                             "waits for the server.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running, and backup the notes every --interval seconds. The "
+                             "browser is kept open between the backups.")
+    parser.add_argument("--interval", type=float, default=3600.,
+                        help="Duration between the start of two backups in daemon mode, in "
+                             "seconds.")
+    parser.add_argument("--search-index",
+                        help="Update a SQLite full-text index of the notes at this path, with "
+                             "only the notes that changed. Search it with `python -m "
+                             "roam_to_git.search INDEX QUERY`. Keep it out of the format "
+                             "directories and of .roam-to-git, that are committed.")
+    parser.add_argument("--metrics-json",
+                        help="Save the wall time, the peak of memory and the number of items of "
+                             "each stage of the run in this JSON file.")
+    parser.add_argument("--metrics-prometheus",
+                        help="Save the metrics of the run in this file, in the text format of "
+                             "Prometheus, for the textfile collector of the node exporter.")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of processes used to format the notes. Use 0 for one "
+                             "process per CPU.")
     args = parser.parse_args()
 
     if args.directory is None:
@@ -76,23 +147,6 @@ def main():
         load_dotenv(git_path / ".env", override=True)
     else:
         logger.debug("No secret found at {}", git_path / ".env")
-    if "ROAMRESEARCH_USER" not in os.environ or "ROAMRESEARCH_PASSWORD" not in os.environ:
-        logger.error("Please define ROAMRESEARCH_USER and ROAMRESEARCH_PASSWORD, "
-                     "in the .env file of your notes repository, or in environment variables")
-        sys.exit(1)
-    config = Config(database=args.database,
-                    debug=args.debug,
-                    gui=args.gui,
-                    sleep_duration=float(args.sleep_duration),
-                    browser=args.browser,
-                    browser_args=args.browser_arg)
-
-    if args.skip_git:
-        repo = None
-    else:
-        repo = git.Repo(git_path)
-        assert not repo.bare  # Fail fast if it's not a repo
-
     if args.formats is None or len(args.formats) == 0:
         args.formats = DEFAULT_FORMATS
 
@@ -100,35 +154,245 @@ def main():
         logger.error("The format values must be one of {}.", ALL_FORMATS)
         sys.exit(1)
 
-    # reset all directories to be modified
-    for f in args.formats:
-        reset_git_directory(git_path / f)
-
     # check if we need to fetch a format from roam
     roam_formats = [f for f in args.formats if f in ROAM_FORMATS]
-    if len(roam_formats) > 0:
-        with create_temporary_directory(autodelete=not config.debug) as root_zip_path:
+    config = None
+    exporter: Optional[Exporter] = None
+    if args.from_archive:
+        exporter = LocalExporter([Path(archive).absolute() for archive in args.from_archive])
+    elif len(roam_formats) > 0:
+        if "ROAMRESEARCH_USER" not in os.environ or "ROAMRESEARCH_PASSWORD" not in os.environ:
+            logger.error("Please define ROAMRESEARCH_USER and ROAMRESEARCH_PASSWORD, "
+                         "in the .env file of your notes repository, or in environment "
+                         "variables")
+            sys.exit(1)
+        # Selenium is only imported when the archives are downloaded from Roam
+        from roam_to_git.scrapping import Config, SeleniumExporter
+        config = Config(database=args.database,
+                        debug=args.debug,
+                        gui=args.gui,
+                        sleep_duration=float(args.sleep_duration),
+                        browser=args.browser,
+                        browser_args=args.browser_arg,
+                        profile_directory=(Path(args.browser_profile).absolute()
+                                           if args.browser_profile else None))
+        exporter = SeleniumExporter(config)
+
+    if args.skip_git:
+        repo = None
+    else:
+        import git
+        repo = git.Repo(git_path)
+        assert not repo.bare  # Fail fast if it's not a repo
+
+    # psutil is only imported when the peak of memory is saved
+    sample_memory = bool(args.metrics_json or args.metrics_prometheus)
+    if args.daemon:
+        run_daemon(args, git_path, repo, roam_formats, exporter, sample_memory)
+        return
+    metrics = Metrics(sample_memory=sample_memory)
+    if exporter is not None and len(roam_formats) > 0:
+        with create_temporary_directory(autodelete=not args.debug) as root_zip_path:
             root_zip_path = Path(root_zip_path)
-            scrap(root_zip_path, roam_formats, config)
-            if config.debug:
+            try:
+                with metrics.stage("export"):
+                    exporter.export(root_zip_path, roam_formats, metrics)
+            finally:
+                exporter.close()
+            if args.debug and config is not None:
                 logger.debug("waiting for the download...")
                 time.sleep(20)
                 return
-            # Unzip and save all the downloaded files.
-            for f in roam_formats:
+            save_backup(args, git_path, repo, root_zip_path, roam_formats, metrics)
+    else:
+        save_backup(args, git_path, repo, None, roam_formats, metrics)
+
+
+def save_backup(args, git_path: Path, repo: Optional["git.Repo"], root_zip_path: Optional[Path],
+                roam_formats: List[str], metrics: Metrics):
+    """Save the downloaded archives and the formatted notes in the repository, and commit them.
+
+    The metrics of the run are saved at the end."""
+    # The link graph of the notes, also used as the index of the incremental mode
+    index_path = git_path / STATE_DIRECTORY / "links.jsonl"
+    previous_index = None
+    if args.incremental and (git_path / "formatted").exists():
+        previous_index = read_note_index(index_path)
+        if previous_index is None:
+            logger.info("No valid index at {}, formatting all the notes", index_path)
+
+    # Directories are not reset: only the files that changed are written, and the files that
+    # are not in the export anymore are removed.
+    writers = {f: DirectoryWriter(git_path / f, workers=args.write_threads)
+               for f in args.formats}
+    # The members of the archives saved by the previous run, to skip the files that didn't change
+    archive_cache_path = git_path / STATE_DIRECTORY / "archives.json"
+    archive_cache = read_archive_cache(archive_cache_path, INDEX_VERSION, repo)
+    unchanged_formats = set()
+    if root_zip_path is not None:
+        # Unzip and save all the downloaded files.
+        for f in roam_formats:
+            members = get_archive_members(root_zip_path / f)
+            previous_members = archive_cache.get(f) if writers[f].directory.exists() else None
+            if members == previous_members:
+                logger.info("The {} archive didn't change since the last run", f)
+                unchanged_formats.add(f)
+                continue
+            with metrics.stage(f"save {f}") as stage:
                 if (f == "markdown") or (f == "formatted"):
                     logger.debug("Unzipping and saving {}", f)
-                    unzip_and_save_archive(f, root_zip_path / f, git_path / f)
+                    unzip_and_save_archive(f, root_zip_path / f, writers[f], previous_members)
+                    if previous_members is None:
+                        writers[f].remove_missing()
                 else:
-                    shutil.copytree(root_zip_path / f, git_path / f, dirs_exist_ok=True)
-    if "formatted" in args.formats:
-        formatted = format_markdown(read_markdown_directory(git_path / "markdown"))
-        save_files("formatted", git_path / "formatted", formatted)
-
-    if repo is not None:
-        commit_git_directory(repo)
-        if not args.skip_push:
-            push_git_repository(repo)
+                    if f == "json":
+                        save_json_archive(root_zip_path / f, writers[f])
+                    else:  # edn
+                        save_edn_directory(root_zip_path / f, writers[f])
+                    writers[f].remove_missing()
+                writers[f].log_summary()
+                stage.counts.update(writers[f].get_counts())
+            archive_cache[f] = members
+    # The link graph of the notes, when they are formatted
+    index: Optional[NoteIndex] = None
+    formatted_notes = False
+    if "markdown" in unchanged_formats and writers.get("formatted") is not None \
+            and writers["formatted"].directory.exists():
+        logger.info("The notes didn't change, they are not formatted again")
+    elif "formatted" in args.formats:
+        formatted_notes = True
+        with metrics.stage("format") as stage:
+            # The notes are read only when needed, to not have all of them in memory
+            contents = MarkdownDirectory(git_path / "markdown")
+            writer = writers["formatted"]
+            if previous_index is not None:
+                formatted, removed, index = format_markdown_incremental(contents, previous_index)
+                logger.debug("Formatted {} notes and removed {} notes",
+                             len(formatted), len(removed))
+                stage.counts["notes"] = len(formatted)
+                for file_name in removed:
+                    writer.remove(file_name)
+                for file_name, content in formatted.items():
+                    writer.save("formatted", file_name, content)
+            else:
+                logger.debug("Saving formatted to {}", writer.directory)
+                index = {}
+                for file_name, content in iter_format_markdown(
+                        contents, jobs=args.jobs or os.cpu_count() or 1, counts=stage.counts,
+                        index=index, low_memory=args.low_memory,
+                        memory_map=args.memory_map):
+                    writer.save("formatted", file_name, content)
+                writer.remove_missing()
+            writer.log_summary()
+            stage.counts.update(writer.get_counts())
+            # Saved last, so an interrupted run is formatted again the next time
+            save_note_index(index_path, index)
+            # Replaced by the link graph
+            legacy_index_path = git_path / STATE_DIRECTORY / "formatted-index.json"
+            if legacy_index_path.exists():
+                legacy_index_path.unlink()
+
+    if args.search_index:
+        with metrics.stage("search index") as stage:
+            contents = MarkdownDirectory(git_path / "markdown")
+            if index is None and "formatted" in args.formats:
+                # The notes didn't change since the link graph was saved
+                index = read_note_index(index_path)
+            if index is None:
+                index = build_note_index(contents)
+            # Only the notes with a hash different from the indexed one are read
+            stage.counts.update(update_search_index(Path(args.search_index), contents, index))
+
+    # The pending writes are finished before the commit
+    for writer in writers.values():
+        writer.close()
+
+    saved = root_zip_path is not None and len(unchanged_formats) < len(roam_formats)
+    if saved:
+        # Committed with the files it describes. If the commit fails, it differs from the one
+        # in HEAD, so the next run saves the archives again.
+        save_archive_cache(archive_cache_path, archive_cache, INDEX_VERSION)
+
+    if repo is not None and (saved or formatted_notes):
+        with metrics.stage("commit"):
+            # Only the directories written by roam-to-git are scanned, not the whole repository.
+            # All their changes are committed, including those of a previous run that failed.
+            commit_git_directory(repo, [writer.directory for writer in writers.values()]
+                                 + [git_path / STATE_DIRECTORY])
+    elif repo is not None:
+        logger.info("Nothing changed, no commit")
+
+    # Without change, the commits not pushed yet can only become due with time
+    if repo is not None and (saved or formatted_notes or args.push_interval is not None):
+        if not args.skip_push and is_push_due(repo, push_every=args.push_every,
+                                              push_interval=args.push_interval):
+            with metrics.stage("push"):
+                push_git_repository(repo, retries=args.push_retries)
+
+    metrics.log_summary()
+    if args.metrics_json:
+        metrics.save_json(Path(args.metrics_json))
+    if args.metrics_prometheus:
+        metrics.save_prometheus(Path(args.metrics_prometheus))
+
+
+def run_daemon(args, git_path: Path, repo: Optional["git.Repo"], roam_formats: List[str],
+               exporter: Optional[Exporter], sample_memory: bool = True):
+    """Backup the notes every args.interval seconds, until SIGINT or SIGTERM.
+
+    The browser and the repository are kept open between the backups, and the next archives
+    are downloaded while the previous ones are saved and committed."""
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        if stop.is_set():
+            raise KeyboardInterrupt()
+        logger.info("Stopping after the current backup. Send the signal again to stop now.")
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    # At most one export waits to be saved, so the downloads don't get ahead of the commits
+    exports: "queue.Queue[Optional[Tuple[Path, Metrics]]]" = queue.Queue(maxsize=1)
+
+    def save_exports():
+        while True:
+            item = exports.get()
+            if item is None:
+                return
+            root_zip_path, metrics = item
+            try:
+                save_backup(args, git_path, repo, root_zip_path, roam_formats, metrics)
+            except Exception:
+                logger.exception("Impossible to save the backup")
+            finally:
+                shutil.rmtree(root_zip_path, ignore_errors=True)
+
+    # A daemon thread, so a second signal doesn't wait for the current commit
+    saver = threading.Thread(target=save_exports, name="save-exports", daemon=True)
+    saver.start()
+    try:
+        while not stop.is_set():
+            start = time.monotonic()
+            root_zip_path = Path(tempfile.mkdtemp(prefix="roam-to-git-"))
+            metrics = Metrics(sample_memory=sample_memory)
+            try:
+                if exporter is not None and len(roam_formats) > 0:
+                    with metrics.stage("export"):
+                        exporter.export(root_zip_path, roam_formats, metrics)
+            except Exception:
+                logger.exception("Impossible to export the archives")
+                shutil.rmtree(root_zip_path, ignore_errors=True)
+            else:
+                exports.put((root_zip_path, metrics))
+            stop.wait(max(0., args.interval - (time.monotonic() - start)))
+        exports.put(None)
+        saver.join()
+    finally:
+        if exporter is not None:
+            exporter.close()
+        _kill_child_process()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,94 @@
+import shutil
+import zipfile
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from roam_to_git.metrics import Metrics
+
+ROAM_FORMATS = ("json", "markdown", "edn")
+
+
+class Exporter(ABC):
+    """Source of the Roam archives.
+
+    export() saves the archive of each format in the sub-directory of zip_path named after the
+    format, where the rest of the pipeline reads them. An exporter can be used for multiple
+    exports, and must be closed after the last one."""
+
+    @abstractmethod
+    def export(self, zip_path: Path, formats: List[str], metrics: Optional[Metrics] = None):
+        """:param metrics: where the stages of the export are measured"""
+
+    def close(self):
+        pass
+
+
+def get_archive_format(archive: Path) -> str:
+    """Return the Roam format of an archive, from the extension of the files it contains"""
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zip_file:
+            suffixes = {Path(file.filename).suffix for file in zip_file.infolist()
+                        if not file.is_dir()}
+    else:
+        suffixes = {archive.suffix}
+    for suffix, archive_format in [(".md", "markdown"), (".json", "json"), (".edn", "edn")]:
+        if suffix in suffixes:
+            return archive_format
+    raise ValueError(f"Impossible to find the format of {archive}")
+
+
+class LocalExporter(Exporter):
+    """Import the archives previously exported from Roam, without any browser.
+
+    The archives are the zip files downloaded from Roam, or the JSON or EDN files they
+    contain."""
+
+    def __init__(self, archives: List[Path]):
+        self.archives: Dict[str, Path] = {}
+        for archive in archives:
+            archive_format = get_archive_format(archive)
+            if archive_format in self.archives:
+                raise ValueError(f"Multiple archives for {archive_format}: "
+                                 f"{self.archives[archive_format]} and {archive}")
+            self.archives[archive_format] = archive
+
+    def export(self, zip_path: Path, formats: List[str], metrics: Optional[Metrics] = None):
+        for output_type in formats:
+            if output_type not in self.archives:
+                raise FileNotFoundError(f"No archive given for {output_type}")
+            archive = self.archives[output_type]
+            format_zip_path = zip_path / output_type
+            format_zip_path.mkdir(exist_ok=True)
+            logger.debug("Import {} from {}", output_type, archive)
+            if zipfile.is_zipfile(archive):
+                shutil.copyfile(archive, format_zip_path / archive.name)
+            else:
+                # The rest of the pipeline reads the files from the zip archive of Roam
+                with zipfile.ZipFile(format_zip_path / f"{archive.stem}.zip", "w") as zip_file:
+                    zip_file.write(archive, archive.name)
+
+
+def _kill_child_process(timeout=50):
+    import psutil
+
+    procs = psutil.Process().children(recursive=True)
+    if not procs:
+        return
+    logger.debug("Terminate child process {}", procs)
+    for p in procs:
+        try:
+            p.terminate()
+        except psutil.NoSuchProcess:
+            pass
+    gone, still_alive = psutil.wait_procs(procs, timeout=timeout)
+    if still_alive:
+        logger.warning(f"Kill child process {still_alive} that was still alive after "
+                       f"'timeout={timeout}' from 'terminate()' command")
+        for p in still_alive:
+            try:
+                p.kill()
+            except psutil.NoSuchProcess:
+                pass
@@ -1,55 +1,602 @@
+import bisect
+import contextlib
+import hashlib
+import json
+import mmap
+import multiprocessing
 import os
 import re
-from collections import defaultdict
-from itertools import takewhile
+from collections import OrderedDict, defaultdict
 from pathlib import Path
-from typing import Dict, List, Match, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Match, NamedTuple, Optional, \
+    Set, Tuple, Union
+
+from roam_to_git.fs import walk_directory
+
+# Version of the format of the incremental index. Bump it when the formatting changes, so that
+# the next run does a full rebuild.
+INDEX_VERSION = 2
 
 
 def read_markdown_directory(raw_directory: Path) -> Dict[str, str]:
-    contents = {}
-    for file in raw_directory.iterdir():
-        if file.is_dir():
-            # We recursively add the content of sub-directories.
-            # They exist when there is a / in the note name.
-            for child_name, content in read_markdown_directory(file).items():
-                contents[f"{file.name}/{child_name}"] = content
-        if not file.is_file():
-            continue
-        content = file.read_text(encoding="utf-8")
-        parts = file.parts[len(raw_directory.parts):]
-        file_name = os.path.join(*parts)
-        contents[file_name] = content
-    return contents
+    return {file_name: file.read_text(encoding="utf-8")
+            for file_name, file in iter_markdown_files(raw_directory)}
+
+
+def iter_markdown_files(raw_directory: Path) -> Iterator[Tuple[str, Path]]:
+    """Yield the note name and the path of all the files of a markdown directory"""
+    # The sub-directories exist when there is a / in the note name
+    for file_name, entry in walk_directory(raw_directory, skip=()):
+        if entry.is_file():
+            yield file_name, Path(entry.path)
+
+
+class MarkdownDirectory(Mapping[str, str]):
+    """The notes of a markdown directory, read from the disk only when they are accessed.
+
+    Unlike read_markdown_directory, the whole graph is never in memory at once. The last notes
+    read are kept in a LRU cache, as a note is often read again soon, like the sources of the
+    backlinks of the notes formatted by the incremental mode.
+    """
+
+    def __init__(self, raw_directory: Path, cache_size: int = 256):
+        self.files = dict(iter_markdown_files(raw_directory))
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+
+    def __getitem__(self, file_name: str) -> str:
+        if file_name in self._cache:
+            self._cache.move_to_end(file_name)
+            return self._cache[file_name]
+        content = self.files[file_name].read_text(encoding="utf-8")
+        if self.cache_size > 0:
+            self._cache[file_name] = content
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return content
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.files)
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+
+class Link(NamedTuple):
+    """A link found in a note, with the position of the text it comes from."""
+    target: str  # Name of the linked note, without the .md suffix
+    start: int
+    end: int
+
+
+class BackLink(NamedTuple):
+    source: str  # File name of the note containing the link
+    start: int  # Position of the link in the source, used to sort the backlinks
+    context: str  # Line of text around the link
+
+
+# The link graph: map a markdown file name to the hash of its content and the links it contains
+NoteIndex = Dict[str, Tuple[str, List[Link]]]
+
+
+# Tokens of a note, matched in a single pass. The order of the alternatives matter, as the
+# first one matching at a position wins.
+_TOKEN_REGEX = re.compile(
+    # TODO and DONE markers: {{[[TODO]]}}
+    r"(?P<to_do>{{(?P<to_do_link>\[\[(?P<to_do_name>TODO|DONE)\]\])}} *)"
+    # Attributes, like '  - attribute::'
+    r"|^(?P<attribute_prefix> *- )(?P<attribute>(?:[^:\n]|:[^:\n])+)::"
+    # Internal reference: [[mynote]]
+    r"|\[\[(?P<link>[^\]\n]+)\]\]"
+    # Hashtags: #mytag
+    r"|#(?P<hashtag>[a-zA-Z-_0-9]+)",
+    flags=re.MULTILINE)
+_HASHTAG_REGEX = re.compile(r"#([a-zA-Z-_0-9]+)")
+_NEW_LINE_REGEX = re.compile(r"\n")
+# The same patterns, to scan the UTF-8 bytes of the notes. The bytes of the non-ASCII characters
+# are all >= 0x80, so they are matched like the characters by the negated classes.
+_TOKEN_BYTES_REGEX = re.compile(_TOKEN_REGEX.pattern.encode("ascii"), flags=re.MULTILINE)
+_HASHTAG_BYTES_REGEX = re.compile(_HASHTAG_REGEX.pattern.encode("ascii"))
+_NEW_LINE_BYTES_REGEX = re.compile(rb"\n")
+_NON_ASCII_BYTES_REGEX = re.compile(rb"[\x80-\xff]")
+
+
+def _scan(content: str) -> Optional[List[Match]]:
+    """Return the tokens of a note, or None if they overlap in a way the single pass can't
+    reproduce.
+
+    format_link applies its regexes one after the other, so a token written by one of them can
+    be rewritten by the following ones, like a [[link]] or a #hashtag inside an attribute
+    name. Those notes are rare, and are formatted with the regexes instead.
+    """
+    tokens = list(_TOKEN_REGEX.finditer(content))
+    for token in tokens:
+        if token.lastgroup == "attribute":
+            name = token.group("attribute")
+            if "[" in name or "#" in name:
+                return None
+        elif token.lastgroup == "link" and "{{[[" in token.group("link"):
+            return None
+    return tokens
+
+
+def _format_and_extract_links(content: str, link_prefix: str = "") -> Tuple[str, List[Link]]:
+    """Format a note and extract its links in a single pass.
+
+    The output is the same as format_link(format_to_do(content)) and extract_links(content).
+    """
+    tokens = _scan(content)
+    if tokens is None:
+        links = [Link(match.group(1), match.start(), match.end())
+                 for match in extract_links(content)]
+        return format_link(format_to_do(content), link_prefix=link_prefix), links
+    if not tokens:
+        return content, []
 
+    def to_markdown_link(name: str) -> str:
+        return f"[{name}](<{link_prefix}{name}.md>)"
 
-def get_back_links(contents: Dict[str, str]) -> Dict[str, List[Tuple[str, Match]]]:
+    pieces = []
+    links = []
+    position = 0
+    for token in tokens:
+        kind = token.lastgroup
+        if kind == "link":
+            name = token.group("link")
+            replacement = to_markdown_link(name)
+            if "#" in name:
+                # The hashtags are formatted after the links, including inside them
+                replacement = _HASHTAG_REGEX.sub(lambda m: to_markdown_link(m.group(1)),
+                                                 replacement)
+            links.append(Link(name, token.start(), token.end()))
+        elif kind == "hashtag":
+            replacement = to_markdown_link(token.group("hashtag"))
+        elif kind == "attribute":
+            name = token.group("attribute")
+            replacement = f"{token.group('attribute_prefix')}**{to_markdown_link(name)}:**"
+            # extract_links matches attributes from the previous line break
+            start = token.start()
+            links.append(Link(name, max(start - 1, 0), token.end()))
+        else:
+            name = token.group("to_do_name")
+            replacement = "[ ] " if name == "TODO" else "[x] "
+            links.append(Link(name, token.start("to_do_link"), token.end("to_do_link")))
+        pieces.append(content[position:token.start()])
+        pieces.append(replacement)
+        position = token.end()
+    pieces.append(content[position:])
+    return "".join(pieces), links
+
+
+def format_content(content: str, link_prefix: str = "") -> str:
+    """Format the TODOs and the links of a note, like format_link(format_to_do(content))"""
+    return _format_and_extract_links(content, link_prefix=link_prefix)[0]
+
+
+def extract_note_links(content: str) -> List[Link]:
+    tokens = _scan(content)
+    if tokens is None:
+        return [Link(match.group(1), match.start(), match.end())
+                for match in extract_links(content)]
+    links = []
+    for token in tokens:
+        kind = token.lastgroup
+        if kind == "link":
+            links.append(Link(token.group("link"), token.start(), token.end()))
+        elif kind == "attribute":
+            start = token.start()
+            links.append(Link(token.group("attribute"), max(start - 1, 0), token.end()))
+        elif kind == "to_do":
+            links.append(Link(token.group("to_do_name"),
+                              token.start("to_do_link"), token.end("to_do_link")))
+    return links
+
+
+def get_link_contexts(content: str, links: List[Link]) -> List[str]:
+    """Return the line of text around each link of a note.
+
+    The line starts are found by bisection in the positions of the line breaks, so the cost
+    is proportional to the size of the contexts, not of the note.
+    """
+    if not links:
+        return []
+    new_lines = [match.start() for match in _NEW_LINE_REGEX.finditer(content)]
+    contexts = []
+    for link in links:
+        n_lines_before = bisect.bisect_left(new_lines, link.start)
+        line_start = new_lines[n_lines_before - 1] + 1 if n_lines_before > 0 else 0
+        # Only the character after the link is kept, if it's on the same line
+        end_context = content[link.end:link.end + 1]
+        if end_context == "\n":
+            end_context = ""
+        contexts.append((content[line_start:link.end] + end_context).strip())
+    return contexts
+
+
+def get_back_links(contents: Mapping[str, str]) -> Dict[str, List[BackLink]]:
     # Extract backlinks from the markdown
-    forward_links = {file_name: extract_links(content) for file_name, content in contents.items()}
-    back_links: Dict[str, List[Tuple[str, Match]]] = defaultdict(list)
-    for file_name, links in forward_links.items():
-        for link in links:
-            back_links[f"{link.group(1)}.md"].append((file_name, link))
+    back_links: Dict[str, List[BackLink]] = defaultdict(list)
+    for file_name, content in contents.items():
+        links = extract_note_links(content)
+        for link, context in zip(links, get_link_contexts(content, links)):
+            back_links[f"{link.target}.md"].append(BackLink(file_name, link.start, context))
     return back_links
 
 
-def format_markdown(contents: Dict[str, str]) -> Dict[str, str]:
-    back_links = get_back_links(contents)
-    # Format and write the markdown files
-    out = {}
+def get_link_prefix(file_name: str) -> str:
+    return "../" * sum("/" in char for char in file_name)
+
+
+# Number of notes sent at once to a worker process
+_CHUNK_SIZE = 64
+
+
+@contextlib.contextmanager
+def _mapper(jobs: int) -> Iterator[Callable]:
+    """Yield a function like map, that runs in a pool of processes if jobs > 1.
+
+    The results are yielded in order, so the output doesn't depend on the number of jobs.
+    """
+    if jobs <= 1:
+        yield map
+    else:
+        with multiprocessing.Pool(jobs) as pool:
+            yield lambda function, iterable: pool.imap(function, iterable, _CHUNK_SIZE)
+
+
+def _format_note_body(item: Tuple[str, str]) -> Tuple[str, str, str, List[Link], List[str]]:
+    file_name, content = item
+    body, links = _format_and_extract_links(content, link_prefix=get_link_prefix(file_name))
+    return file_name, hash_content(content), body, links, get_link_contexts(content, links)
+
+
+def _extract_note_links_and_contexts(item: Tuple[str, str]
+                                     ) -> Tuple[str, str, str, List[Link], List[str]]:
+    """Like _format_note_body, without the formatted note"""
+    file_name, content = item
+    links = extract_note_links(content)
+    return file_name, hash_content(content), "", links, get_link_contexts(content, links)
+
+
+def _format_note_with_back_links(item: Tuple[str, str, List[BackLink]]) -> str:
+    file_name, content, back_links = item
+    link_prefix = get_link_prefix(file_name)
+    return (format_content(content, link_prefix=link_prefix)
+            + format_content(format_back_links(back_links), link_prefix=link_prefix))
+
+
+def _format_back_links_section(item: Tuple[str, List[BackLink]]) -> str:
+    file_name, back_links = item
+    return format_content(format_back_links(back_links), link_prefix=get_link_prefix(file_name))
+
+
+# Size from which the notes are mapped in memory. Mapping the small ones is slower than reading
+# them, as most notes are a few KB.
+_MAP_MIN_SIZE = 256 * 1024
+
+
+@contextlib.contextmanager
+def _map_file(path: Path) -> Iterator[Union[bytes, mmap.mmap]]:
+    """Map a file in memory, read-only, or read it if it's small"""
+    with path.open("rb") as f:
+        if os.fstat(f.fileno()).st_size < _MAP_MIN_SIZE:
+            yield f.read()
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def _scan_bytes(data: Union[bytes, mmap.mmap]) -> Optional[List[Match[bytes]]]:
+    """Like _scan, on the UTF-8 bytes of a note"""
+    tokens = list(_TOKEN_BYTES_REGEX.finditer(data))
+    for token in tokens:
+        if token.lastgroup == "attribute":
+            name = token.group("attribute")
+            if b"[" in name or b"#" in name:
+                return None
+        elif token.lastgroup == "link" and b"{{[[" in token.group("link"):
+            return None
+    return tokens
+
+
+def _get_char_positions(data: Union[bytes, mmap.mmap], byte_links: List[Tuple[bytes, int, int]]
+                        ) -> Optional[Dict[int, int]]:
+    """Map the positions of the links in the UTF-8 bytes of a note to their positions in the
+    decoded note. Return None if they are the same, when the note is ASCII."""
+    if _NON_ASCII_BYTES_REGEX.search(data) is None:
+        return None
+    char_positions = {}
+    byte_position = char_position = 0
+    for position in sorted({p for _, start, end in byte_links for p in (start, end)}):
+        char_position += len(data[byte_position:position].decode("utf-8"))
+        byte_position = position
+        char_positions[position] = char_position
+    return char_positions
+
+
+def _get_char_end(data: Union[bytes, mmap.mmap], position: int) -> int:
+    """Return the end of the UTF-8 character starting at a position"""
+    lead = data[position:position + 1]
+    if not lead or lead < b"\xc0":
+        return position + len(lead)
+    return position + (2 if lead < b"\xe0" else 3 if lead < b"\xf0" else 4)
+
+
+def _format_mapped_note_body(item: Tuple[str, Path, bool]
+                             ) -> Tuple[str, str, bytes, List[Link], List[str]]:
+    """Like _format_note_body, from a file mapped in memory and scanned as bytes.
+
+    The formatted note stays encoded in UTF-8, and only the names of the links and the contexts
+    are decoded. The positions of the links are those in the decoded note, so the link graph is
+    the same. The notes the single pass can't scan, or with \\r that read_text would translate,
+    are decoded and formatted as str.
+
+    :param item: the file name, the path, and False to only extract the links and the contexts
+    """
+    file_name, path, with_body = item
+    with _map_file(path) as data:
+        tokens = None if data.find(b"\r") != -1 else _scan_bytes(data)
+        if tokens is None:
+            content = path.read_text(encoding="utf-8")
+            format_ = _format_note_body if with_body else _extract_note_links_and_contexts
+            _, content_hash, formatted, links, contexts = format_((file_name, content))
+            return file_name, content_hash, formatted.encode("utf-8"), links, contexts
+
+        link_prefix = get_link_prefix(file_name).encode("utf-8")
+
+        def to_markdown_link(name: bytes) -> bytes:
+            return b"[%b](<%b%b.md>)" % (name, link_prefix, name)
+
+        pieces = []
+        # The links, with their name and their position in bytes
+        byte_links: List[Tuple[bytes, int, int]] = []
+        position = 0
+        for token in tokens:
+            kind = token.lastgroup
+            if kind == "link":
+                name = token.group("link")
+                byte_links.append((name, token.start(), token.end()))
+                replacement = to_markdown_link(name)
+                if b"#" in name:
+                    replacement = _HASHTAG_BYTES_REGEX.sub(
+                        lambda m: to_markdown_link(m.group(1)), replacement)
+            elif kind == "hashtag":
+                replacement = to_markdown_link(token.group("hashtag"))
+            elif kind == "attribute":
+                name = token.group("attribute")
+                byte_links.append((name, max(token.start() - 1, 0), token.end()))
+                replacement = (token.group("attribute_prefix") + b"**" + to_markdown_link(name)
+                               + b":**")
+            else:
+                name = token.group("to_do_name")
+                byte_links.append((name, token.start("to_do_link"), token.end("to_do_link")))
+                replacement = b"[ ] " if name == b"TODO" else b"[x] "
+            if with_body:
+                pieces.append(data[position:token.start()])
+                pieces.append(replacement)
+                position = token.end()
+        body = b""
+        if with_body:
+            pieces.append(data[position:])
+            body = b"".join(pieces)
+
+        links = []
+        contexts = []
+        if byte_links:
+            new_lines = [match.start() for match in _NEW_LINE_BYTES_REGEX.finditer(data)]
+            char_positions = _get_char_positions(data, byte_links)
+            for name, start, end in byte_links:
+                # Like get_link_contexts, the line and the character after the link
+                n_lines_before = bisect.bisect_left(new_lines, start)
+                line_start = new_lines[n_lines_before - 1] + 1 if n_lines_before > 0 else 0
+                context_end = end if data[end:end + 1] == b"\n" else _get_char_end(data, end)
+                contexts.append(data[line_start:context_end].decode("utf-8").strip())
+                if char_positions is not None:
+                    start, end = char_positions[start], char_positions[end]
+                links.append(Link(name.decode("utf-8"), start, end))
+        return file_name, hashlib.sha1(data).hexdigest(), body, links, contexts
+
+
+def _format_mapped_note_with_back_links(item: Tuple[str, Path, List[BackLink]]) -> str:
+    file_name, path, back_links = item
+    body = _format_mapped_note_body((file_name, path, True))[2]
+    return body.decode("utf-8") + _format_back_links_section((file_name, back_links))
+
+
+def format_markdown(contents: Mapping[str, str], jobs: int = 1) -> Dict[str, str]:
+    return dict(iter_format_markdown(contents, jobs=jobs))
+
+
+def iter_format_markdown(contents: Mapping[str, str], jobs: int = 1,
+                         counts: Optional[Dict[str, int]] = None,
+                         index: Optional[NoteIndex] = None,
+                         low_memory: bool = False,
+                         memory_map: bool = False,
+                         ) -> Iterator[Tuple[str, str]]:
+    """Format all the notes, and add their Backlinks section.
+
+    Each note is read only once from contents, and the formatted notes are yielded one at a
+    time, so they can be saved without keeping them all in memory.
+
+    :param jobs: number of processes used to format the notes. Each note is sent to only one
+        process, with the context of its backlinks.
+    :param counts: if given, the number of notes and links are added to it
+    :param index: if given, it's filled with the link graph of the notes, like
+        build_note_index(contents) but without scanning the notes again
+    :param low_memory: don't keep the formatted notes until their Backlinks section is
+        built. Each note is read and scanned twice, but only the contexts of the backlinks
+        stay in memory, with contents like a MarkdownDirectory.
+    :param memory_map: read the files of contents, a MarkdownDirectory, as bytes, with the
+        large ones mapped in memory, and format them as bytes. The formatted notes are kept in
+        UTF-8 until they are yielded, which is up to 4 times smaller than a str for the notes
+        with a few non-ASCII characters, like an emoji. The output is the same.
+    """
+    files: Dict[str, Path] = {}
+    if memory_map:
+        if not isinstance(contents, MarkdownDirectory):
+            raise TypeError("memory_map needs the notes of a MarkdownDirectory")
+        files = contents.files
+    # The notes are formatted while extracting the backlinks, so that they are scanned only once.
+    # Backlinks sections don't depend on the formatting of the note, so they are added after.
+    back_links: Dict[str, List[BackLink]] = defaultdict(list)
+    formatted = {}
+    if memory_map:
+        extract: Callable = _format_mapped_note_body
+        items: Iterable = ((file_name, path, not low_memory)
+                           for file_name, path in files.items())
+    else:
+        extract = _extract_note_links_and_contexts if low_memory else _format_note_body
+        items = contents.items()
+    with _mapper(jobs) as map_:
+        for file_name, content_hash, body, links, contexts in map_(extract, items):
+            formatted[file_name] = body
+            if index is not None:
+                index[file_name] = (content_hash, links)
+            if counts is not None:
+                counts["notes"] = counts.get("notes", 0) + 1
+                counts["links"] = counts.get("links", 0) + len(links)
+            for link, context in zip(links, contexts):
+                back_links[f"{link.target}.md"].append(BackLink(file_name, link.start, context))
+
+        file_names = list(formatted)
+        if low_memory and memory_map:
+            notes = map_(_format_mapped_note_with_back_links,
+                         ((file_name, files[file_name], back_links.pop(file_name, []))
+                          for file_name in file_names))
+        elif low_memory:
+            # The notes are read again, one at a time
+            notes = map_(_format_note_with_back_links,
+                         ((file_name, contents[file_name], back_links.pop(file_name, []))
+                          for file_name in file_names))
+        else:
+            # Backlinks content will be formatted like the rest of the note
+            sections = map_(_format_back_links_section,
+                            ((file_name, back_links.pop(file_name, []))
+                             for file_name in file_names))
+            bodies = (formatted.pop(file_name) for file_name in file_names)
+            if memory_map:
+                bodies = (body.decode("utf-8") for body in bodies)
+            notes = (body + section for body, section in zip(bodies, sections))
+        for file_name, content in zip(file_names, notes):
+            if len(content) > 0:
+                yield file_name, content
+
+
+def format_note(file_name: str, content: str, back_links: List[BackLink]) -> str:
+    # Backlinks content will be formatted automatically.
+    content = add_back_links(content, back_links)
+    return format_content(content, link_prefix=get_link_prefix(file_name))
+
+
+def hash_content(content: str) -> str:
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def _get_link_files(links: List[Link]) -> Set[str]:
+    return {f"{link.target}.md" for link in links}
+
+
+def build_note_index(contents: Mapping[str, str]) -> NoteIndex:
+    return {file_name: (hash_content(content), extract_note_links(content))
+            for file_name, content in contents.items()}
+
+
+def get_back_link_graph(index: NoteIndex) -> Dict[str, List[Tuple[str, int]]]:
+    """Return the file names and the link positions of the notes linking to each note"""
+    back_links: Dict[str, List[Tuple[str, int]]] = defaultdict(list)
+    for file_name in sorted(index):
+        for link in index[file_name][1]:
+            back_links[f"{link.target}.md"].append((file_name, link.start))
+    return back_links
+
+
+def format_markdown_incremental(contents: Mapping[str, str], previous_index: NoteIndex
+                                ) -> Tuple[Dict[str, str], List[str], NoteIndex]:
+    """Format only the notes impacted by the changes since the index was built.
+
+    A note needs to be formatted again if its content changed, or if a note linking to it
+    (before or after the change) changed, as its Backlinks section depends on it.
+
+    :return: the formatted notes that changed, the file names of the formatted notes to remove,
+        and the index of the new contents.
+    """
+    index: NoteIndex = {}
+    changed: Set[str] = set()
     for file_name, content in contents.items():
-        # We add the backlinks first, because they use the position of the characters
-        # of the regex matches
-        content = add_back_links(content, back_links[file_name])
-
-        # Format content. Backlinks content will be formatted automatically.
-        content = format_to_do(content)
-        link_prefix = "../" * sum("/" in char for char in file_name)
-        content = format_link(content, link_prefix=link_prefix)
+        content_hash = hash_content(content)
+        previous = previous_index.get(file_name)
+        if previous is not None and previous[0] == content_hash:
+            index[file_name] = previous
+        else:
+            changed.add(file_name)
+            index[file_name] = (content_hash, extract_note_links(content))
+    removed = set(previous_index) - set(contents)
+
+    to_format = set(changed)
+    for file_name in changed | removed:
+        for note_index in (previous_index, index):
+            if file_name in note_index:
+                to_format.update(_get_link_files(note_index[file_name][1]))
+    to_format &= set(contents)
+
+    # Only the notes linking to a note to format are needed to build its Backlinks section
+    sources = {file_name for file_name, (_, links) in index.items()
+               if not to_format.isdisjoint(_get_link_files(links))}
+    back_links = get_back_links({file_name: contents[file_name] for file_name in sources})
+
+    out = {}
+    for file_name in sorted(to_format):
+        content = format_note(file_name, contents[file_name], back_links[file_name])
         if len(content) > 0:
             out[file_name] = content
+        else:
+            removed.add(file_name)
+    return out, sorted(removed), index
 
-    return out
+
+def read_note_index(path: Path) -> Optional[NoteIndex]:
+    """Read an index saved by save_note_index. Return None if it's missing, outdated or
+    invalid."""
+    if not path.exists():
+        return None
+    try:
+        with path.open(encoding="utf-8") as f:
+            header = json.loads(f.readline() or "{}")
+            if header.get("version") != INDEX_VERSION:
+                return None
+            index = {}
+            for line in f:
+                note = json.loads(line)
+                index[note["note"]] = (note["hash"], [Link(*link) for link in note["links"]])
+    except (ValueError, KeyError, TypeError):  # Like a line truncated by an interrupted run
+        return None
+    return index
+
+
+def save_note_index(path: Path, index: NoteIndex):
+    """Save the link graph as JSON lines, with a header line and one line per note.
+
+    Each note has its hash, its links with their target and their position in the note, and
+    the file names and link positions of the notes linking to it. The file is replaced once
+    written, so it's never read half written.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    back_links = get_back_link_graph(index)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with tmp_path.open("w", encoding="utf-8") as f:
+            f.write(json.dumps({"version": INDEX_VERSION}) + "\n")
+            for file_name in sorted(index):
+                content_hash, links = index[file_name]
+                note = {"note": file_name, "hash": content_hash, "links": links,
+                        "back_links": back_links.get(file_name, [])}
+                f.write(json.dumps(note, ensure_ascii=True, separators=(",", ":")) + "\n")
+        tmp_path.replace(path)
+    except BaseException:
+        # Not left in the state directory, that is committed
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
 
 
 def format_to_do(contents: str):
@@ -69,30 +616,25 @@ def extract_links(string: str) -> List[Match]:
     return out
 
 
-def add_back_links(content: str, back_links: List[Tuple[str, Match]]) -> str:
+def add_back_links(content: str, back_links: List[BackLink]) -> str:
+    return content + format_back_links(back_links)
+
+
+def format_back_links(back_links: List[BackLink]) -> str:
+    """Return the Backlinks section of a note, before formatting"""
     if not back_links:
-        return content
-    files = sorted(set((file_name[:-3], match) for file_name, match in back_links),
-                   key=lambda e: (e[0], e[1].start()))
+        return ""
+    files = sorted(set((back_link.source[:-3], back_link.start, back_link.context)
+                       for back_link in back_links))
     new_lines = []
     file_before = None
-    for file, match in files:
+    for file, _, context in files:
         if file != file_before:
             new_lines.append(f"## [{file}](<{file}.md>)")
         file_before = file
-
-        start_context_ = list(takewhile(lambda c: c != "\n", match.string[:match.start()][::-1]))
-        start_context = "".join(start_context_[::-1])
-
-        middle_context = match.string[match.start():match.end()]
-
-        end_context_ = takewhile(lambda c: c != "\n", match.string[match.end()])
-        end_context = "".join(end_context_)
-
-        context = (start_context + middle_context + end_context).strip()
         new_lines.extend([context, ""])
     backlinks_str = "\n".join(new_lines)
-    return f"{content}\n# Backlinks\n{backlinks_str}\n"
+    return f"\n# Backlinks\n{backlinks_str}\n"
 
 
 def format_link(string: str, link_prefix="") -> str:
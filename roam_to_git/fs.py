@@ -1,17 +1,28 @@
 import contextlib
 import datetime
 import json
+import os
 import platform
+import shutil
 import tempfile
+import time
 import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from json.encoder import encode_basestring_ascii
 from pathlib import Path
-from typing import Dict, List
-from subprocess import Popen, PIPE, STDOUT
+from typing import TYPE_CHECKING, Any, Container, Deque, Dict, Iterable, Iterator, List, Optional, \
+    Set, Tuple
+from subprocess import Popen, PIPE
 
-import git
 import pathvalidate
 from loguru import logger
 
+# GitPython is imported by the functions using it, so formatting the notes doesn't load it
+if TYPE_CHECKING:
+    import git
+
 
 def get_zip_path(zip_dir_path: Path) -> Path:
     """Return the path to the single zip file in a directory, and fail if there is not one single
@@ -23,79 +34,692 @@ def get_zip_path(zip_dir_path: Path) -> Path:
     return zip_path
 
 
+def walk_directory(directory: Path, skip: Container[str] = (".git",)
+                   ) -> Iterator[Tuple[str, "os.DirEntry[str]"]]:
+    """Yield the name relative to the directory, with / separators, and the entry of all the
+    files and sub-directories of a directory.
+
+    A sub-directory is yielded before its content, so the reversed list of the sub-directories
+    has the children before their parents. The entries with a name in skip are not yielded, and
+    the directories with a name in skip are not scanned. The types of the entries come from
+    scandir, without a stat of each file, and the symbolic links are not followed.
+    """
+    directories = [(os.fspath(directory), "")]
+    while directories:
+        path, prefix = directories.pop()
+        # Listed before being yielded, so the caller can remove the files
+        with os.scandir(path) as scanned:
+            entries = list(scanned)
+        sub_directories = []
+        for entry in entries:
+            if entry.name in skip:
+                continue
+            name = prefix + entry.name
+            yield name, entry
+            if entry.is_dir(follow_symlinks=False):
+                sub_directories.append((entry.path, name + "/"))
+        # Reversed, so the sub-directories are visited in the order of scandir
+        directories.extend(reversed(sub_directories))
+
+
 def reset_git_directory(git_path: Path, skip=(".git",)):
     """Remove all files in a git directory"""
-    to_remove: List[Path] = []
-    for file in git_path.glob("**/*"):
-        if any(skip_item in file.parts for skip_item in skip):
-            continue
-        to_remove.append(file)
+    directories = []
+    for _, entry in walk_directory(git_path, skip):
+        if entry.is_dir(follow_symlinks=False):
+            directories.append(entry.path)
+        else:
+            os.unlink(entry.path)
     # Now we remove starting from the end to remove children before parents
-    to_remove = sorted(set(to_remove))[::-1]
-    for file in to_remove:
-        if file.is_file():
-            file.unlink()
-        elif file.is_dir():
-            if list(file.iterdir()):
-                logger.debug("Impossible to remove directory {}", file)
-            else:
-                file.rmdir()
-
-
-def unzip_archive(zip_dir_path: Path):
+    for directory in reversed(directories):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            logger.debug("Impossible to remove directory {}", directory)
+
+
+def unzip_archive(zip_dir_path: Path) -> Dict[str, str]:
+    return dict(iter_archive_files(zip_dir_path))
+
+
+def iter_archive_files(zip_dir_path: Path, members: Optional[Container[str]] = None
+                       ) -> Iterator[Tuple[str, str]]:
+    """Yield the name and the content of the files of the archive, one at a time
+
+    :param members: if given, only these files are unzipped
+    """
     logger.debug("Unzipping {}", zip_dir_path)
-    zip_path = get_zip_path(zip_dir_path)
+    return _iter_zip_files(get_zip_path(zip_dir_path), members)
+
+
+def _iter_zip_files(zip_path: Path, members: Optional[Container[str]] = None
+                    ) -> Iterator[Tuple[str, str]]:
     with zipfile.ZipFile(zip_path) as zip_file:
-        contents = {file.filename: zip_file.read(file.filename).decode()
-                    for file in zip_file.infolist()
-                    if not file.is_dir()}
-    return contents
+        for file in zip_file.infolist():
+            if not file.is_dir() and (members is None or file.filename in members):
+                yield file.filename, zip_file.read(file.filename).decode()
 
 
-def save_files(save_format: str, directory: Path, contents: Dict[str, str]):
-    logger.debug("Saving {} to {}", save_format, directory)
-    for file_name, content in contents.items():
-        dest = get_clean_path(directory, file_name)
-        dest.parent.mkdir(parents=True, exist_ok=True)  # Needed if a new directory is used
-        # We have to specify encoding because crontab on Mac don't use UTF-8
-        # https://stackoverflow.com/questions/11735363/python3-unicodeencodeerror-crontab
-        with dest.open("w", encoding="utf-8") as f:
-            if save_format == 'json':
-                json.dump(json.loads(content), f, sort_keys=True, indent=2, ensure_ascii=True)
-            else:  # markdown, formatted, edn
-                if save_format == 'edn':
-                    try:
-                        jet = Popen(
-                            ["jet", "--edn-reader-opts", "{:default tagged-literal}", "--pretty"],
-                            stdout=PIPE, stdin=PIPE, stderr=STDOUT)
-                        jet_stdout, _ = jet.communicate(input=str.encode(content))
-                        content = jet_stdout.decode()
-                    except IOError:
-                        logger.debug("Jet not installed, skipping EDN pretty printing")
-
-                f.write(content)
-
-
-def unzip_and_save_archive(save_format: str, zip_dir_path: Path, directory: Path):
+ARCHIVE_CACHE_VERSION = 1
+# Name of the files of an archive, with a hash of their content
+ArchiveMembers = Dict[str, str]
+
+
+def get_archive_members(zip_dir_path: Path) -> ArchiveMembers:
+    """Return the files of the archives of a directory, with their CRC and their size.
+
+    Only the central directory of the zip archives is read, not the files they contain.
+    """
+    members = {}
+    for path in sorted(zip_dir_path.iterdir()):
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as zip_file:
+                for file in zip_file.infolist():
+                    if not file.is_dir():
+                        members[file.filename] = f"{file.CRC:08x}-{file.file_size}"
+        elif path.is_file():
+            data = path.read_bytes()
+            members[path.name] = f"{zlib.crc32(data):08x}-{len(data)}"
+    return members
+
+
+def read_archive_cache(path: Path, index_version: int, repo: Optional["git.Repo"] = None
+                       ) -> Dict[str, ArchiveMembers]:
+    """Read the members of the archives of the previous run, by format. Return an empty cache
+    if it's missing or outdated.
+
+    :param index_version: the version of the formatting, that formats the notes again when it
+        changes.
+    :param repo: if given, the cache is only valid if it's the one committed in HEAD, with the
+        files it describes. Otherwise the run that saved it failed before its commit.
+    """
+    if not path.exists():
+        return {}
+    data = json.loads(path.read_text(encoding="utf-8"))
+    if (data.get("version"), data.get("index_version")) != (ARCHIVE_CACHE_VERSION, index_version):
+        return {}
+    if repo is not None and data != _read_committed_json(repo, path):
+        return {}
+    return data["archives"]
+
+
+def _read_committed_json(repo: "git.Repo", path: Path):
+    """Return the content of a JSON file in HEAD, or None if it's not committed"""
+    assert repo.working_tree_dir is not None
+    if not repo.head.is_valid():
+        return None
+    try:
+        blob = repo.head.commit.tree[Path(os.path.relpath(path, repo.working_tree_dir))
+                                     .as_posix()]
+    except KeyError:
+        return None
+    # Parsed, since the line endings may be converted in the working tree
+    return json.loads(blob.data_stream.read().decode("utf-8"))
+
+
+def save_archive_cache(path: Path, cache: Dict[str, ArchiveMembers], index_version: int):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = {"version": ARCHIVE_CACHE_VERSION, "index_version": index_version, "archives": cache}
+    with path.open("w", encoding="utf-8") as f:
+        json.dump(data, f, indent=0, sort_keys=True, ensure_ascii=True)
+
+
+def save_files(save_format: str, directory: Path, contents: Dict[str, str], workers: int = 1):
+    """Save all the files, with workers threads"""
     logger.debug("Saving {} to {}", save_format, directory)
-    contents = unzip_archive(zip_dir_path)
-    save_files(save_format, directory, contents)
+    writer = DirectoryWriter(directory, workers=workers)
+    try:
+        for file_name, content in contents.items():
+            writer.save(save_format, file_name, content)
+    finally:
+        writer.close()
+
+
+def save_file(save_format: str, directory: Path, file_name: str, content: str):
+    dest = get_clean_path(directory, file_name)
+    dest.parent.mkdir(parents=True, exist_ok=True)  # Needed if a new directory is used
+    # We have to specify encoding because crontab on Mac don't use UTF-8
+    # https://stackoverflow.com/questions/11735363/python3-unicodeencodeerror-crontab
+    with dest.open("w", encoding="utf-8") as f:
+        f.write(render_file(save_format, content))
+
+
+def render_file(save_format: str, content: str) -> str:
+    """Return the text to save for a file of the given format"""
+    if save_format == 'json':
+        return dump_canonical_json(json.loads(content))
+    if save_format == 'edn':  # markdown and formatted are saved as is
+        content, = pretty_print_edn([content])
+    return content
+
+
+def dump_canonical_json(value) -> str:
+    """Same as json.dumps(value, sort_keys=True, indent=2, ensure_ascii=True), but faster.
+
+    The json module uses its C encoder only without indentation.
+    """
+    parts: List[str] = []
+    append = parts.append
+
+    def dump(value, indent: str):
+        if isinstance(value, str):
+            append(encode_basestring_ascii(value))
+        elif value is None:
+            append("null")
+        elif value is True:
+            append("true")
+        elif value is False:
+            append("false")
+        elif isinstance(value, int):
+            append(int.__repr__(value))
+        elif isinstance(value, float):
+            append(json.dumps(value))
+        elif isinstance(value, dict):
+            if not value:
+                append("{}")
+                return
+            inner_indent = indent + "  "
+            separator = "{\n" + inner_indent
+            for key in sorted(value):
+                if not isinstance(key, str):
+                    raise TypeError(f"Unsupported key {key!r}")
+                append(separator)
+                append(encode_basestring_ascii(key))
+                append(": ")
+                dump(value[key], inner_indent)
+                separator = ",\n" + inner_indent
+            append("\n" + indent + "}")
+        elif isinstance(value, list):
+            if not value:
+                append("[]")
+                return
+            inner_indent = indent + "  "
+            separator = "[\n" + inner_indent
+            for item in value:
+                append(separator)
+                dump(item, inner_indent)
+                separator = ",\n" + inner_indent
+            append("\n" + indent + "]")
+        else:
+            raise TypeError(f"Unsupported value {value!r}")
+
+    try:
+        dump(value, "")
+    except TypeError:
+        # Let the json module deal with the corner cases, like keys that are not strings
+        return json.dumps(value, sort_keys=True, indent=2, ensure_ascii=True)
+    return "".join(parts)
+
+
+def _skip_json_whitespace(content: str, position: int) -> int:
+    while content[position:position + 1] in (" ", "\t", "\n", "\r"):
+        position += 1
+    return position
+
+
+def iter_json_list(content: str) -> Iterator:
+    """Yield the items of a JSON list one at a time, without parsing the whole list at once"""
+    decoder = json.JSONDecoder()
+    position = _skip_json_whitespace(content, 0)
+    if content[position:position + 1] != "[":
+        raise ValueError("The JSON content is not a list")
+    position = _skip_json_whitespace(content, position + 1)
+    if content[position:position + 1] == "]":
+        return
+    while True:
+        item, position = decoder.raw_decode(content, position)
+        yield item
+        position = _skip_json_whitespace(content, position)
+        separator = content[position:position + 1]
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError(f"Invalid JSON list at position {position}")
+        position = _skip_json_whitespace(content, position + 1)
+
+
+JET_COMMAND = ["jet", "--edn-reader-opts", "{:default tagged-literal}", "--pretty"]
+# Top-level EDN value written after each document, so a single jet process can pretty print
+# several documents. jet prints it on its own line, where it can't be part of a document.
+_EDN_SEPARATOR = ":roam-to-git/end-of-document\n"
+
+
+def _run_jet(content: str) -> Optional[str]:
+    """Pretty print EDN with jet. Return None if it failed."""
+    jet = Popen(JET_COMMAND, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+    jet_stdout, jet_stderr = jet.communicate(input=content.encode())
+    if jet.returncode != 0:
+        logger.warning("jet failed with exit code {}: {}", jet.returncode,
+                       jet_stderr.decode(errors="replace").strip())
+        return None
+    return jet_stdout.decode()
+
+
+def pretty_print_edn(documents: List[str]) -> List[str]:
+    """Pretty print EDN documents with jet, if it's installed.
+
+    All the documents are sent to the same jet process, to start it only once. If it fails, each
+    document is pretty printed on its own, and the documents jet can't read are kept as is.
+    """
+    if not documents:
+        return []
+    if shutil.which(JET_COMMAND[0]) is None:
+        logger.debug("Jet not installed, skipping EDN pretty printing")
+        return documents
+    if len(documents) > 1:
+        output = _run_jet("".join(f"{document}\n{_EDN_SEPARATOR}" for document in documents))
+        if output is not None:
+            pretty_documents = output.split(_EDN_SEPARATOR)
+            # The last item is what is after the last separator, so it should be empty
+            if len(pretty_documents) == len(documents) + 1 and not pretty_documents[-1].strip():
+                return pretty_documents[:-1]
+        logger.warning("Impossible to pretty print the EDN documents together, "
+                       "pretty printing them one by one")
+    pretty_documents = []
+    for document in documents:
+        output = _run_jet(document)
+        pretty_documents.append(document if output is None else output)
+    return pretty_documents
+
+
+def encode_text(text: str) -> bytes:
+    """Return the bytes written by a file opened in text mode"""
+    if os.linesep != "\n":
+        text = text.replace("\n", os.linesep)
+    return text.encode("utf-8")
+
+
+def _write_if_changed(dest: Path, data: bytes) -> str:
+    """Write a file if its content changed, and return "added", "changed" or "unchanged"."""
+    try:
+        size = dest.stat().st_size
+    except FileNotFoundError:
+        outcome = "added"
+    else:
+        # Comparing the size first avoids reading most of the changed files
+        if size == len(data) and dest.read_bytes() == data:
+            return "unchanged"
+        outcome = "changed"
+    dest.write_bytes(data)
+    return outcome
 
 
-def commit_git_directory(repo: git.Repo):
-    """Add an automatic commit in a git directory if it has changed, and push it"""
-    if not repo.is_dirty() and not repo.untracked_files:
+class DirectoryWriter:
+    """Write files in a directory, only when their content changed.
+
+    The files that were not written are deleted by remove_missing, so the directory ends up
+    like if it was reset before writing, without touching the files that didn't change. This
+    keeps their modification time, and git doesn't have to hash them again.
+
+    With workers > 1, the files are written by a pool of threads, as writing many small files
+    is bound by the latency of the disk on network file systems. The errors of the writes are
+    raised by flush(), that is called by the other methods. Use close() to stop the threads.
+    """
+
+    def __init__(self, directory: Path, skip=(".git",), workers: int = 1):
+        self.directory = directory
+        self.skip = skip
+        self.written: Set[Path] = set()
+        self.added = 0
+        self.changed = 0
+        self.removed = 0
+        self.unchanged = 0
+        self.bytes_written = 0
+        self.workers = workers
+        # Directories known to exist, so each one is created only once
+        self._directories: Set[Path] = set()
+        self._executor = ThreadPoolExecutor(workers) if workers > 1 else None
+        self._pending: Deque[Tuple[Path, int, "Future[str]"]] = deque()
+
+    def save(self, save_format: str, file_name: str, content: str):
+        self.save_text(file_name, render_file(save_format, content))
+
+    def save_text(self, file_name: str, text: str):
+        self.write_bytes(file_name, encode_text(text))
+
+    def write_bytes(self, file_name: str, data: bytes):
+        self.write_bytes_to(get_clean_path(self.directory, file_name), data)
+
+    def write_bytes_to(self, dest: Path, data: bytes):
+        """Write a file, from its path already cleaned by get_clean_path"""
+        if self._executor is not None and dest in self.written:
+            self.flush()  # The previous write of the same file could be pending
+        self.written.add(dest)
+        parent = dest.parent
+        if parent not in self._directories:
+            parent.mkdir(parents=True, exist_ok=True)  # Needed if a new directory is used
+            self._directories.add(parent)
+        if self._executor is None:
+            self._count(dest, len(data), _write_if_changed(dest, data))
+            return
+        # A few writes per thread are pending at most, to bound the memory used by their data
+        if len(self._pending) >= 4 * self.workers:
+            self._wait_oldest()
+        self._pending.append((dest, len(data), self._executor.submit(_write_if_changed, dest,
+                                                                     data)))
+
+    def _count(self, dest: Path, size: int, outcome: str):
+        if outcome == "unchanged":
+            self.unchanged += 1
+            return
+        if outcome == "added":
+            self.added += 1
+        else:
+            self.changed += 1
+        self.bytes_written += size
+
+    def _wait_oldest(self):
+        dest, size, future = self._pending.popleft()
+        self._count(dest, size, future.result())
+
+    def flush(self):
+        """Wait for all the pending writes, and raise the first error if one failed"""
+        error = None
+        while self._pending:
+            try:
+                self._wait_oldest()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def close(self):
+        """Wait for the pending writes, and stop the threads"""
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def remove(self, file_name: str):
+        """Remove a file, and its parent directories if they become empty"""
+        self.flush()
+        dest = get_clean_path(self.directory, file_name)
+        if not dest.is_file():
+            return
+        dest.unlink()
+        self.removed += 1
+        parent = dest.parent
+        while parent != self.directory and not any(parent.iterdir()):
+            parent.rmdir()
+            self._directories.discard(parent)
+            parent = parent.parent
+
+    def remove_missing(self):
+        """Remove all the files that were not written, and the empty directories"""
+        self.flush()
+        # On a case-insensitive file system, a file may have been written with another case
+        written_cases = {_get_case_key(file): file for file in self.written}
+        directories = []
+        for _, entry in walk_directory(self.directory, self.skip):
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+                continue
+            file = Path(entry.path)
+            written = written_cases.get(_get_case_key(file))
+            if written is None or written != file and not _is_same_file(file, written):
+                file.unlink()
+                self.removed += 1
+        # Children are removed before their parents
+        for directory in reversed(directories):
+            try:
+                os.rmdir(directory)
+            except OSError:  # Not empty
+                continue
+            self._directories.discard(Path(directory))
+
+    def get_counts(self) -> Dict[str, int]:
+        self.flush()
+        return {"added": self.added, "changed": self.changed, "removed": self.removed,
+                "unchanged": self.unchanged, "bytes_written": self.bytes_written}
+
+    def log_summary(self):
+        self.flush()
+        logger.info("{}: {} added, {} changed, {} removed, {} unchanged", self.directory,
+                    self.added, self.changed, self.removed, self.unchanged)
+
+
+def unzip_and_save_archive(save_format: str, zip_dir_path: Path, writer: DirectoryWriter,
+                           previous_members: Optional[ArchiveMembers] = None):
+    """Save the files of an archive.
+
+    :param previous_members: the members of the archive already saved in the directory. If
+        given, only the files that changed are unzipped, and the files that are not in the
+        archive anymore are removed. Otherwise use writer.remove_missing() to remove them.
+    """
+    logger.debug("Saving {} to {}", save_format, writer.directory)
+    members = None
+    if previous_members is not None:
+        current_members = get_archive_members(zip_dir_path)
+        members = {file_name for file_name, content_hash in current_members.items()
+                   if previous_members.get(file_name) != content_hash}
+        logger.debug("{} files changed in the archive", len(members))
+        for file_name in previous_members:
+            if file_name not in current_members:
+                writer.remove(file_name)
+    # The files are written as soon as they are unzipped, to not keep the whole archive in memory
+    for file_name, content in iter_archive_files(zip_dir_path, members):
+        writer.save(save_format, file_name, content)
+
+
+def save_json_archive(zip_dir_path: Path, writer: DirectoryWriter):
+    """Save a JSON export with one file per page, so the diffs of a page stay in its file.
+
+    The pages are parsed and written one at a time, so the whole graph is never parsed at once.
+    The pages that would have the same file, like "Foo" and "foo" on a case-insensitive file
+    system, are numbered in the order of their uid, so their files don't depend on the order of
+    the export.
+    """
+    logger.debug("Saving json to {}", writer.directory)
+    # The first page saved in each file, by case-folded path
+    saved: Dict[str, Tuple[Path, str]] = {}
+    # The other pages with the same case-folded path, with their title
+    duplicates: Dict[str, List[Tuple[str, dict]]] = {}
+    for file_name, content in iter_archive_files(zip_dir_path):
+        if not content.lstrip().startswith("["):
+            writer.save("json", file_name, content)
+            continue
+        for i, page in enumerate(iter_json_list(content)):
+            title = page.get("title") if isinstance(page, dict) else None
+            if not isinstance(title, str):
+                title = f"{file_name[:-len('.json')]}-{i}"
+            dest = get_clean_path(writer.directory, f"{title}.json")
+            # Different titles may have the same file name once cleaned
+            key = _get_case_key(dest)
+            if key in saved:
+                duplicates.setdefault(key, []).append((title, page))
+                continue
+            saved[key] = (dest, title)
+            writer.write_bytes_to(dest, encode_text(dump_canonical_json(page)))
+
+    if duplicates:
+        writer.flush()
+    for key, pages in sorted(duplicates.items()):
+        dest, title = saved[key]
+        # Read back, to not keep all the pages in memory
+        pages.append((title, json.loads(dest.read_text(encoding="utf-8"))))
+        pages.sort(key=_get_page_order)
+        first_title, first_page = pages[0]
+        if first_title != title:
+            writer.written.discard(dest)
+            dest = get_clean_path(writer.directory, f"{first_title}.json")
+        writer.write_bytes_to(dest, encode_text(dump_canonical_json(first_page)))
+        n = 1
+        for title, page in pages[1:]:
+            while True:
+                n += 1
+                dest = get_clean_path(writer.directory, f"{title} ({n}).json")
+                if _get_case_key(dest) not in saved:
+                    break
+            saved[_get_case_key(dest)] = (dest, title)
+            writer.write_bytes_to(dest, encode_text(dump_canonical_json(page)))
+
+
+def _get_case_key(path: Path) -> str:
+    """Return a key equal for the paths of the same file on a case-insensitive file system"""
+    return str(path).casefold()
+
+
+def _is_same_file(file: Path, other: Path) -> bool:
+    try:
+        return os.path.samefile(file, other)
+    except OSError:
+        return False
+
+
+def _get_page_order(titled_page: Tuple[str, Any]) -> Tuple[str, str, str]:
+    title, page = titled_page
+    uid = page.get("uid") if isinstance(page, dict) else None
+    return str(uid or ""), title, dump_canonical_json(page)
+
+
+def save_edn_directory(source: Path, writer: DirectoryWriter):
+    """Copy all the files of a directory, with the EDN files pretty printed.
+
+    The EDN files in zip archives are extracted."""
+    edn_files = {}
+    for file in source.glob("**/*"):
+        if not file.is_file():
+            continue
+        file_name = file.relative_to(source).as_posix()
+        if file.suffix == ".edn":
+            edn_files[file_name] = file.read_text(encoding="utf-8")
+        elif file.suffix == ".zip":
+            edn_files.update(_iter_zip_files(file))
+        else:
+            writer.write_bytes(file_name, file.read_bytes())
+    for file_name, text in zip(edn_files, pretty_print_edn(list(edn_files.values()))):
+        writer.save_text(file_name, text)
+
+
+# Number of paths given at once to git add, to stay below the limit of the command line
+_GIT_ADD_BATCH_SIZE = 1000
+
+
+def commit_git_directory(repo: "git.Repo", paths: Optional[Iterable[Path]] = None):
+    """Add an automatic commit in a git directory if it has changed, and push it
+
+    :param paths: if given, only these files or directories are committed, like the directories
+        written by roam-to-git, without scanning the whole working tree. All the changes in
+        them are committed, including those left by a previous run that failed.
+    """
+    message = f"Automatic commit {datetime.datetime.now().isoformat()}"
+    if paths is None:
+        if not repo.is_dirty() and not repo.untracked_files:
+            # No change, nothing to do
+            return
+        logger.debug("Committing git repository {}", repo.git_dir)
+        repo.git.add(A=True)  # https://github.com/gitpython-developers/GitPython/issues/292
+        repo.index.commit(message)
+        return
+
+    assert repo.working_tree_dir is not None
+    # git runs in the working tree, so the paths are relative to it
+    pathspecs = _get_stageable_paths(repo, sorted({os.path.relpath(path, repo.working_tree_dir)
+                                                   for path in paths}))
+    if not pathspecs:
         # No change, nothing to do
         return
-    logger.debug("Committing git repository {}", repo.git_dir)
-    repo.git.add(A=True)  # https://github.com/gitpython-developers/GitPython/issues/292
-    repo.index.commit(f"Automatic commit {datetime.datetime.now().isoformat()}")
+    logger.debug("Committing {} paths in git repository {}", len(pathspecs), repo.git_dir)
+    for i in range(0, len(pathspecs), _GIT_ADD_BATCH_SIZE):
+        # -A also stages the removed files. The paths are not patterns: a page name can
+        # contain [, * or ?
+        repo.git(literal_pathspecs=True).add("-A", "--",
+                                             *pathspecs[i:i + _GIT_ADD_BATCH_SIZE])
+    # The commit is created from the index, without git commit that checks the working tree.
+    # GitPython falls back to user@hostname when git has no identity configured.
+    index = repo.index
+    tree = index.write_tree()
+    if repo.head.is_valid() and repo.head.commit.tree == tree:
+        # The files were written back to their committed content
+        return
+    index.commit(message)
+
+
+def _get_stageable_paths(repo: "git.Repo", pathspecs: List[str]) -> List[str]:
+    """Return the paths git add accepts, like git add -A on the whole working tree.
+
+    git add fails on a path that is ignored, or that is neither in the working tree nor in
+    the index, like a file removed before being committed.
+    """
+    assert repo.working_tree_dir is not None
+    existing = {path for path in pathspecs
+                if os.path.lexists(os.path.join(repo.working_tree_dir, path))}
+    missing = [path for path in pathspecs if path not in existing]
+    # The tracked files, and their parent directories
+    tracked: Set[str] = set()
+    for i in range(0, len(missing), _GIT_ADD_BATCH_SIZE):
+        # -z, to not have the non-ASCII names quoted
+        for file in repo.git(literal_pathspecs=True).ls_files(
+                "-z", "--", *missing[i:i + _GIT_ADD_BATCH_SIZE]).split("\0"):
+            parts = file.split("/")
+            tracked.update("/".join(parts[:n]) for n in range(1, len(parts) + 1))
+    ignored: Set[str] = set()
+    sorted_existing = sorted(existing)
+    for i in range(0, len(sorted_existing), _GIT_ADD_BATCH_SIZE):
+        batch = sorted_existing[i:i + _GIT_ADD_BATCH_SIZE]
+        ignored.update(str(path) for path in repo.ignored(*batch))
+    return [path for path in pathspecs
+            if (path in existing or path in tracked) and path not in ignored]
+
+
+def is_push_due(repo: "git.Repo", push_every: int = 1, push_interval: Optional[float] = None
+                ) -> bool:
+    """Return True if the commits not pushed yet should be pushed.
+
+    The commits are pushed once there are push_every of them, or when the oldest of them is
+    older than push_interval seconds. This only reads the commits since the remote-tracking
+    branch, so it works in a shallow clone.
+    """
+    import git
+
+    try:
+        branch = git.Head(repo, repo.active_branch.path)
+    except TypeError:  # Detached HEAD
+        return True
+    upstream = branch.tracking_branch()
+    if upstream is None or not upstream.is_valid():
+        # Never pushed, we don't know what the remote has
+        return True
+    unpushed = list(repo.iter_commits(f"{upstream.path}..HEAD"))
+    if not unpushed:
+        return False
+    if len(unpushed) >= push_every:
+        return True
+    if push_interval is not None:
+        oldest = min(commit.committed_date for commit in unpushed)
+        return time.time() - oldest >= push_interval
+    return False
+
+
+def push_git_repository(repo: "git.Repo", retries: int = 3, backoff: float = 2.):
+    """Push to origin, and retry with an exponential backoff on failure
 
+    :param retries: number of tries after the first failure
+    :param backoff: duration to wait before the first retry, doubled at each retry
+    """
+    import git
 
-def push_git_repository(repo: git.Repo):
     logger.debug("Pushing to origin")
     origin = repo.remote(name='origin')
-    origin.push()
+    for attempt in range(retries + 1):
+        try:
+            push_infos = origin.push()
+            errors = [info.summary.strip() for info in push_infos
+                      if info.flags & (info.ERROR | info.REJECTED | info.REMOTE_REJECTED
+                                       | info.REMOTE_FAILURE)]
+            if not push_infos:
+                errors.append("nothing was pushed")
+            if errors:
+                raise git.GitCommandError(["git", "push"], 1, "; ".join(errors))
+            return
+        except git.GitCommandError as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            logger.warning("Push failed, retrying in {}s: {}", delay, e)
+            time.sleep(delay)
 
 
 def get_clean_path(directory: Path, file_name: str) -> Path:
@@ -0,0 +1,160 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from loguru import logger
+
+# Prefix of the names of the Prometheus metrics
+PROMETHEUS_PREFIX = "roam_to_git"
+
+
+class Stage:
+    """Measures of a stage of a run"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.time()
+        self.duration = 0.
+        self.peak_rss = 0
+        # Number of items processed by the stage, like notes, links or bytes written
+        self.counts: Dict[str, int] = defaultdict(int)
+
+    def to_json(self) -> dict:
+        return {"name": self.name, "start": self.start, "duration": self.duration,
+                "peak_rss": self.peak_rss, "counts": dict(self.counts)}
+
+
+def get_rss() -> int:
+    """Return the resident memory of the process and its children, like the formatting pool"""
+    import psutil
+
+    process = psutil.Process()
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss
+
+
+class Metrics:
+    """Measure the wall time, the peak of memory and the number of items of the stages of a run.
+
+    The memory is sampled by a thread while at least one stage is running, unless
+    sample_memory is False. It's only saved by save_json and save_prometheus, and sampling it
+    imports psutil.
+    """
+
+    def __init__(self, sample_interval: float = .05, sample_memory: bool = True):
+        self.sample_interval = sample_interval
+        self.sample_memory = sample_memory
+        self.start = time.time()
+        self.stages: List[Stage] = []
+        self._running: List[Stage] = []
+        self._lock = threading.Lock()
+        self._sampler: Optional[threading.Thread] = None
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[Stage]:
+        stage = Stage(name)
+        if self.sample_memory:
+            stage.peak_rss = get_rss()
+        with self._lock:
+            self.stages.append(stage)
+            self._running.append(stage)
+            if self.sample_memory and self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name="metrics",
+                                                 daemon=True)
+                self._sampler.start()
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.duration = time.perf_counter() - start
+            rss = get_rss() if self.sample_memory else 0
+            with self._lock:
+                stage.peak_rss = max(stage.peak_rss, rss)
+                self._running.remove(stage)
+            logger.debug("{} done in {:.1f}s", name, stage.duration)
+
+    def _sample(self):
+        while True:
+            rss = get_rss()
+            with self._lock:
+                if not self._running:
+                    self._sampler = None
+                    return
+                for stage in self._running:
+                    stage.peak_rss = max(stage.peak_rss, rss)
+            time.sleep(self.sample_interval)
+
+    def log_summary(self):
+        logger.info("Timing: {}", ", ".join(f"{stage.name} {stage.duration:.1f}s"
+                                            for stage in self.stages))
+
+    def to_json(self) -> dict:
+        return {"start": self.start, "duration": time.time() - self.start,
+                "peak_rss": max((stage.peak_rss for stage in self.stages), default=0),
+                "stages": [stage.to_json() for stage in self.stages]}
+
+    def save_json(self, path: Path):
+        _write_atomically(path, json.dumps(self.to_json(), indent=2) + "\n")
+
+    def to_prometheus(self) -> str:
+        """Format the metrics in the text format of Prometheus.
+
+        The stages run multiple times, like the export of each format, are aggregated."""
+        durations: Dict[str, float] = defaultdict(float)
+        peak_rss: Dict[str, int] = defaultdict(int)
+        counts: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        for stage in self.stages:
+            durations[stage.name] += stage.duration
+            peak_rss[stage.name] = max(peak_rss[stage.name], stage.peak_rss)
+            for item, count in stage.counts.items():
+                counts[stage.name][item] += count
+
+        lines = []
+
+        def add_metric(name: str, description: str, values: Dict[str, object]):
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {description}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} gauge")
+            for labels, value in values.items():
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}{labels} {value}")
+
+        add_metric("last_run_timestamp_seconds", "Start of the last run", {"": self.start})
+        add_metric("stage_duration_seconds", "Wall time of the stage",
+                   {_labels(stage=name): duration for name, duration in durations.items()})
+        add_metric("stage_peak_rss_bytes", "Peak of resident memory during the stage",
+                   {_labels(stage=name): rss for name, rss in peak_rss.items()})
+        add_metric("stage_items", "Number of items processed by the stage",
+                   {_labels(stage=name, item=item): count
+                    for name, stage_counts in counts.items()
+                    for item, count in stage_counts.items()})
+        return "\n".join(lines) + "\n"
+
+    def save_prometheus(self, path: Path):
+        """Save the metrics for the textfile collector of the Prometheus node exporter"""
+        _write_atomically(path, self.to_prometheus())
+
+
+def _labels(**labels: str) -> str:
+    values = ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels.items())
+    return "{" + values + "}"
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _write_atomically(path: Path, text: str):
+    """Write a file, so that it's never read half written"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(text, encoding="utf-8")
+    tmp_path.replace(path)
@@ -1,18 +1,30 @@
 import atexit
 import os
-import pdb
+import shutil
 import sys
+import tempfile
 import time
+import zipfile
 from pathlib import Path
-from typing import List, Optional
+from typing import Callable, List, Optional, Set
 
-import psutil
 from loguru import logger
 from selenium import webdriver
+from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException, \
+    TimeoutException
 
-ROAM_FORMATS = ("json", "markdown", "edn")
+from roam_to_git.exporter import Exporter, _kill_child_process
+from roam_to_git.metrics import Metrics
+
+
+def _set_trace():
+    """Start the debugger in the frame of the caller, pdb is only imported in debug mode"""
+    import pdb
+    pdb.Pdb().set_trace(sys._getframe().f_back)
 
 
 class Browser:
@@ -20,16 +32,15 @@ class Browser:
     PHANTOMJS = "PhantomJS"
     CHROME = "Chrome"
 
-    def __init__(self, browser, output_directory, headless=True, debug=False):
+    def __init__(self, browser, output_directory, headless=True, debug=False,
+                 profile_directory: Optional[Path] = None):
         if browser == Browser.FIREFOX:
-            logger.trace("Configure Firefox Profile Firefox")
-            firefox_profile = webdriver.FirefoxProfile()
-
-            firefox_profile.set_preference("browser.download.folderList", 2)
-            firefox_profile.set_preference("browser.download.manager.showWhenStarting", False)
-            firefox_profile.set_preference("browser.download.dir", str(output_directory))
-            firefox_profile.set_preference(
-                "browser.helperApps.neverAsk.saveToDisk", "application/zip")
+            preferences = {
+                "browser.download.folderList": 2,
+                "browser.download.manager.showWhenStarting": False,
+                "browser.download.dir": str(output_directory),
+                "browser.helperApps.neverAsk.saveToDisk": "application/zip",
+            }
 
             logger.trace("Configure Firefox Profile Options")
             firefox_options = webdriver.FirefoxOptions()
@@ -37,6 +48,22 @@ class Browser:
                 logger.trace("Set Firefox as headless")
                 firefox_options.headless = True
 
+            if profile_directory is None:
+                logger.trace("Configure Firefox Profile Firefox")
+                firefox_profile = webdriver.FirefoxProfile()
+                for name, value in preferences.items():
+                    firefox_profile.set_preference(name, value)
+            else:
+                # A FirefoxProfile is a copy, so Firefox is started on the directory itself to
+                # keep the session between the runs.
+                logger.trace("Use Firefox Profile {}", profile_directory)
+                profile_directory.mkdir(parents=True, exist_ok=True)
+                firefox_profile = None
+                firefox_options.add_argument("-profile")
+                firefox_options.add_argument(str(profile_directory))
+                for name, value in preferences.items():
+                    firefox_options.set_preference(name, value)
+
             logger.trace("Start Firefox")
             self.browser = webdriver.Firefox(firefox_profile=firefox_profile,
                                              firefox_options=firefox_options)
@@ -45,7 +72,7 @@ class Browser:
             raise NotImplementedError()
             # TODO configure
             # self.browser = webdriver.PhantomJS()
-        elif browser == Browser.Chrome:
+        elif browser == Browser.CHROME:
             raise NotImplementedError()
             # TODO configure
             # self.browser = webdriver.Chrome()
@@ -59,31 +86,49 @@ class Browser:
             try:
                 self.browser.get(url)
             except Exception:
-                pdb.set_trace()
+                _set_trace()
         else:
             self.browser.get(url)
 
     def find_element_by_css_selector(self, css_selector, check=True) -> "HTMLElement":
         if self.debug and check:
             try:
-                return self.browser.find_element_by_css_selector(css_selector)
+                element = self.browser.find_element_by_css_selector(css_selector)
             except NoSuchElementException:
-                pdb.set_trace()
+                _set_trace()
                 raise
-        element = self.browser.find_element_by_css_selector(css_selector)
+        else:
+            element = self.browser.find_element_by_css_selector(css_selector)
         return HTMLElement(element, debug=self.debug)
 
     def find_element_by_link_text(self, text) -> "HTMLElement":
         elements = self.browser.find_elements_by_link_text(text)
         if len(elements) != 1:
             if self.debug:
-                pdb.set_trace()
+                _set_trace()
             elements_str = [e.text for e in elements]
             raise ValueError(
                 f"Got {len(elements)} elements, expected 1 for {text}: {elements_str}")
         element, = elements
         return HTMLElement(element, debug=self.debug)
 
+    def wait_until(self, condition: Callable, timeout: float):
+        """Wait until condition(driver) returns a truthy value, and return it"""
+        return WebDriverWait(self.browser, timeout).until(condition)
+
+    def wait_for_element(self, css_selector, timeout: float, clickable=False) -> "HTMLElement":
+        if clickable:
+            condition = expected_conditions.element_to_be_clickable
+        else:
+            condition = expected_conditions.presence_of_element_located
+        element = self.wait_until(condition((By.CSS_SELECTOR, css_selector)), timeout)
+        return HTMLElement(element, debug=self.debug)
+
+    def wait_for_link_text(self, text, timeout: float) -> "HTMLElement":
+        element = self.wait_until(
+            expected_conditions.element_to_be_clickable((By.LINK_TEXT, text)), timeout)
+        return HTMLElement(element, debug=self.debug)
+
     def close(self):
         self.browser.close()
 
@@ -98,7 +143,7 @@ class HTMLElement:
             try:
                 return self.html_element.click()
             except Exception:
-                pdb.set_trace()
+                _set_trace()
         else:
             return self.html_element.click()
 
@@ -107,7 +152,7 @@ class HTMLElement:
             try:
                 return self.html_element.send_keys(keys)
             except Exception:
-                pdb.set_trace()
+                _set_trace()
         else:
             return self.html_element.send_keys(keys)
 
@@ -123,7 +168,8 @@ class Config:
                  debug: bool,
                  gui: bool,
                  sleep_duration: float = 2.,
-                 browser_args: Optional[List[str]] = None):
+                 browser_args: Optional[List[str]] = None,
+                 profile_directory: Optional[Path] = None):
         self.user = os.environ["ROAMRESEARCH_USER"]
         self.password = os.environ["ROAMRESEARCH_PASSWORD"]
         assert self.user
@@ -138,113 +184,170 @@ class Config:
         self.sleep_duration = sleep_duration
         self.browser = getattr(Browser, browser.upper())
         self.browser_args = (browser_args or [])
+        self.profile_directory = profile_directory
+
+    @property
+    def load_timeout(self) -> float:
+        """Maximum duration to wait for Roam to load"""
+        return 100 * self.sleep_duration
 
 
-def download_rr_archive(output_type: str,
-                        output_directory: Path,
-                        config: Config,
-                        slow_motion=10,
-                        ):
-    logger.debug("Creating browser")
-    browser = Browser(browser=config.browser,
-                      headless=not config.gui,
-                      debug=config.debug,
-                      output_directory=output_directory)
+def _graph_loaded(driver) -> str:
+    """Condition on the Roam interface, to wait until the graph is loaded.
 
-    if config.debug:
+    :return: "loaded" if the graph is loaded, "databases" if we are stuck on the list of the
+        databases, "signin" if the session is expired, or an empty string if the page is still
+        loading.
+    """
+    if driver.find_elements_by_css_selector(".bp3-icon-more"):
+        return "loaded"
+    if driver.find_elements_by_css_selector("input[name='email']"):
+        return "signin"
+    try:
+        for strong in driver.find_elements_by_css_selector("strong"):
+            if "database's you are an admin of" == strong.text.lower():
+                return "databases"
+    except StaleElementReferenceException:
         pass
+    return ""
+
+
+def _open_graph(browser: Browser, config: Config, metrics: Metrics):
+    """Sign-in into Roam, and wait for the graph to load.
+
+    With a persistent profile, the session of the previous run is used if it's still valid.
+    """
+    if config.profile_directory is not None and config.database:
+        with metrics.stage("restore session"):
+            go_to_database(browser, config.database)
+            state = _wait_graph_loaded(browser, config)
+        if state == "loaded":
+            logger.debug("Session restored from {}", config.profile_directory)
+            return
+        logger.debug("Session expired, sign-in again")
+
+    with metrics.stage("sign-in"):
+        signin(browser, config, sleep_duration=config.sleep_duration)
+
+    with metrics.stage("load graph"):
+        if config.database:
+            go_to_database(browser, config.database)
+        state = _wait_graph_loaded(browser, config)
+        if state == "signin":
+            raise AssertionError("Roam is still asking to sign-in. Please check your credentials")
+
+
+def _wait_graph_loaded(browser: Browser, config: Config) -> str:
+    logger.debug("Wait for interface to load")
     try:
-        return _download_rr_archive(browser, output_type, output_directory, config)
-    except (KeyboardInterrupt, SystemExit):
-        logger.debug("Closing browser on interrupt {}", output_type)
-        browser.close()
-        logger.debug("Closed browser {}", output_type)
-        raise
-    finally:
-        logger.debug("Closing browser {}", output_type)
-        browser.close()
-        logger.debug("Closed browser {}", output_type)
+        # Starting is a little bit slow, so we wait for the button that signal it's ok.
+        # If we have multiple databases, we will be stuck. Let's detect that.
+        state = browser.wait_until(_graph_loaded, config.load_timeout)
+    except TimeoutException:
+        raise AssertionError("All roads leads to Roam, but that one is too long. Try "
+                             "again when Roam servers are faster.") from None
+    if state == "databases":
+        logger.error(
+            "You seems to have multiple databases. Please select it with the option "
+            "--database")
+        sys.exit(1)
+    return state
 
 
 def _download_rr_archive(browser: Browser,
                          output_type: str,
                          output_directory: Path,
                          config: Config,
-                         ):
-    """Download an archive in RoamResearch.
+                         metrics: Metrics,
+                         ) -> Path:
+    """Download an archive in RoamResearch, once the graph is loaded.
 
     :param output_type: Download JSON or Markdown or EDN
-    :param output_directory: Directory where to stock the outputs
+    :param output_directory: Directory where the browser saves the downloads
+    :return: the path of the downloaded archive
     """
-    signin(browser, config, sleep_duration=config.sleep_duration)
-
-    if config.database:
-        go_to_database(browser, config.database)
+    # Click on something empty to remove the eventual popup
+    # "Sync Quick Capture Notes with Workspace"
+    # TODO browser.mouse.click(0, 0)
 
-    logger.debug("Wait for interface to load")
-    dot_button = None
-    for _ in range(100):
-        # Starting is a little bit slow, so we wait for the button that signal it's ok
-        time.sleep(config.sleep_duration)
+    with metrics.stage(f"export dialog {output_type}"):
+        dot_button = browser.wait_for_element(".bp3-icon-more", config.load_timeout,
+                                              clickable=True)
+        dot_button.click()
+
+        logger.debug("Launch download popup")
+        export_all = browser.wait_for_link_text("Export All", config.load_timeout)
+        export_all.click()
+
+        # Configure download type
+        dropdown_button = browser.wait_for_element(".bp3-dialog .bp3-button-text",
+                                                   config.load_timeout, clickable=True)
+        if output_type.lower() != dropdown_button.text.lower():
+            logger.debug("Changing output type to {}", output_type)
+            dropdown_button.click()
+            output_type_elem = browser.wait_for_link_text(output_type.upper(),
+                                                          config.load_timeout)
+            output_type_elem.click()
+
+        # defensive check
         try:
-            dot_button = browser.find_element_by_css_selector(".bp3-icon-more", check=False)
-            break
-        except NoSuchElementException:
+            browser.wait_until(lambda _: dropdown_button.text.lower() == output_type.lower(),
+                               config.load_timeout)
+        except TimeoutException:
             pass
+        assert dropdown_button.text.lower() == output_type.lower(), \
+            (dropdown_button.text, output_type)
 
-        # If we have multiple databases, we will be stuck. Let's detect that.
-        time.sleep(config.sleep_duration)
-        try:
-            strong = browser.find_element_by_css_selector("strong", check=False)
-        except NoSuchElementException:
-            continue
-        if "database's you are an admin of" == strong.text.lower():
-            logger.error(
-                "You seems to have multiple databases. Please select it with the option "
-                "--database")
-            sys.exit(1)
+        # The files of the previous downloads are ignored
+        previous_files = set(output_directory.iterdir())
 
-    assert dot_button is not None, "All roads leads to Roam, but that one is too long. Try " \
-                                   "again when Roam servers are faster."
+        # Click on "Export All"
+        export_all_confirm = browser.wait_for_element(".bp3-intent-primary",
+                                                      config.load_timeout, clickable=True)
+        export_all_confirm.click()
+
+    with metrics.stage(f"download {output_type}"):
+        logger.debug("Wait download of {} to {}", output_type, output_directory)
+        return wait_for_download(output_directory, output_type, previous_files)
 
-    # Click on something empty to remove the eventual popup
-    # "Sync Quick Capture Notes with Workspace"
-    # TODO browser.mouse.click(0, 0)
 
-    dot_button.click()
-
-    logger.debug("Launch download popup")
-    export_all = browser.find_element_by_link_text("Export All")
-    export_all.click()
-    time.sleep(config.sleep_duration)
-
-    # Configure download type
-    dropdown_button = browser.find_element_by_css_selector(".bp3-dialog .bp3-button-text")
-    if output_type.lower() != dropdown_button.text.lower():
-        logger.debug("Changing output type to {}", output_type)
-        dropdown_button.click()
-        output_type_elem = browser.find_element_by_link_text(output_type.upper())
-        output_type_elem.click()
-
-    # defensive check
-    assert dropdown_button.text.lower() == output_type.lower(), (dropdown_button.text, output_type)
-
-    # Click on "Export All"
-    export_all_confirm = browser.find_element_by_css_selector(".bp3-intent-primary")
-    export_all_confirm.click()
-
-    logger.debug("Wait download of {} to {}", output_type, output_directory)
-    for i in range(1, 60 * 10):
-        time.sleep(1)
-        if i % 60 == 0:
-            logger.debug("Keep waiting for {}, {}s elapsed", output_type, i)
-        for file in output_directory.iterdir():
-            if file.name.endswith(".zip") or file.name.endswith(output_type.lower()):
-                logger.debug("File {} found for {}", file, output_type)
-                time.sleep(1)
-                return
-    logger.debug("Waiting too long {}")
-    raise FileNotFoundError("Impossible to download {} in {}", output_type, output_directory)
+def _is_complete_download(file: Path, output_type: str) -> bool:
+    if file.name.endswith(".zip"):
+        # The central directory is at the end of the zip, so it's only valid once complete
+        return zipfile.is_zipfile(file)
+    return file.name.endswith(output_type.lower()) and file.stat().st_size > 0
+
+
+def wait_for_download(output_directory: Path,
+                      output_type: str,
+                      previous_files: Set[Path],
+                      timeout: float = 60 * 10,
+                      poll_interval: float = .1,
+                      ) -> Path:
+    """Wait until the browser has finished downloading a new file in output_directory.
+
+    Firefox downloads to a .part file, and creates the final file empty until the download is
+    complete, so we wait for a complete file with no .part file left.
+    """
+    deadline = time.monotonic() + timeout
+    next_log = time.monotonic() + 60
+    while True:
+        new_files = set(output_directory.iterdir()) - previous_files
+        if not any(file.name.endswith(".part") for file in new_files):
+            for file in new_files:
+                if _is_complete_download(file, output_type):
+                    logger.debug("File {} found for {}", file, output_type)
+                    return file
+        now = time.monotonic()
+        if now > deadline:
+            logger.debug("Waiting too long {}", output_type)
+            raise FileNotFoundError(
+                f"Impossible to download {output_type} in {output_directory}")
+        if now > next_log:
+            logger.debug("Keep waiting for {}, {:.0f}s elapsed",
+                         output_type, now - deadline + timeout)
+            next_log += 60
+        time.sleep(poll_interval)
 
 
 def signin(browser: Browser, config: Config, sleep_duration=1.):
@@ -255,9 +358,13 @@ def signin(browser: Browser, config: Config, sleep_duration=1.):
     logger.debug("Waiting for  email and password fields", config.user)
     while True:
         try:
-            email_elem = browser.find_element_by_css_selector("input[name='email']", check=False)
+            email_elem = browser.wait_for_element("input[name='email']", 100 * sleep_duration)
             passwd_elem = browser.find_element_by_css_selector("input[name='password']")
 
+            # Clear the fields, that may have been filled by a previous attempt
+            email_elem.html_element.clear()
+            passwd_elem.html_element.clear()
+
             logger.debug("Fill email '{}'", config.user)
             email_elem.send_keys(config.user)
 
@@ -265,7 +372,6 @@ def signin(browser: Browser, config: Config, sleep_duration=1.):
             passwd_elem.send_keys(config.password)
 
             logger.debug("Defensive check: verify that the user input field is correct")
-            time.sleep(sleep_duration)
             email_elem = browser.find_element_by_css_selector("input[name='email']", check=False)
             if email_elem.html_element.get_attribute('value') != config.user:
                 continue
@@ -275,10 +381,18 @@ def signin(browser: Browser, config: Config, sleep_duration=1.):
             break
         except NoSuchElementException:
             logger.trace("NoSuchElementException: Retry getting the email field")
-            time.sleep(1)
         except StaleElementReferenceException:
             logger.trace("StaleElementReferenceException: Retry getting the email field")
-            time.sleep(1)
+
+    # The sign-in form is still there until Roam accepts the credentials, so the graph is
+    # only opened once it's gone
+    logger.debug("Waiting for the sign-in form to disappear")
+    try:
+        browser.wait_until(expected_conditions.staleness_of(passwd_elem.html_element),
+                           100 * sleep_duration)
+    except TimeoutException:
+        raise AssertionError("Roam is still asking to sign-in. Please check your "
+                             "credentials") from None
 
 
 def go_to_database(browser, database):
@@ -288,34 +402,75 @@ def go_to_database(browser, database):
     browser.get(url)
 
 
-def _kill_child_process(timeout=50):
-    procs = psutil.Process().children(recursive=True)
-    if not procs:
-        return
-    logger.debug("Terminate child process {}", procs)
-    for p in procs:
-        try:
-            p.terminate()
-        except psutil.NoSuchProcess:
-            pass
-    gone, still_alive = psutil.wait_procs(procs, timeout=timeout)
-    if still_alive:
-        logger.warning(f"Kill child process {still_alive} that was still alive after "
-                       f"'timeout={timeout}' from 'terminate()' command")
-        for p in still_alive:
-            try:
-                p.kill()
-            except psutil.NoSuchProcess:
-                pass
+class SeleniumExporter(Exporter):
+    """Export the archives from the Roam interface, in a browser driven by Selenium.
 
+    The browser is kept open between the exports, and the graph is only reloaded."""
 
-def scrap(zip_path: Path, formats: List[str], config: Config):
-    # Register to always kill child process when the script close, to not have zombie process.
-    # TODO: is is still needed with Selenium?
-    if not config.debug:
-        atexit.register(_kill_child_process)
+    def __init__(self, config: Config):
+        self.config = config
+        self.browser: Optional[Browser] = None
+        self.download_directory: Optional[Path] = None
 
-    for f in formats:
-        format_zip_path = zip_path / f
-        format_zip_path.mkdir(exist_ok=True)
-        download_rr_archive(f, format_zip_path, config=config)
+    def export(self, zip_path: Path, formats: List[str], metrics: Optional[Metrics] = None):
+        log_summary = metrics is None
+        if metrics is None:
+            metrics = Metrics()
+        try:
+            browser = self._open_browser(metrics)
+            assert self.download_directory is not None
+            for output_type in formats:
+                with metrics.stage(f"export {output_type}"):
+                    archive = _download_rr_archive(browser, output_type, self.download_directory,
+                                                   self.config, metrics)
+                format_zip_path = zip_path / output_type
+                format_zip_path.mkdir(exist_ok=True)
+                # The browser downloads all the archives to the same directory, so they are
+                # moved after each download.
+                shutil.move(str(archive), str(format_zip_path / archive.name))
+        except BaseException:
+            # The browser may be in any state, it's started again for the next export
+            self.close()
+            raise
+        finally:
+            if log_summary:
+                metrics.log_summary()
+
+    def _open_browser(self, metrics: Metrics) -> Browser:
+        if self.browser is not None:
+            with metrics.stage("reload graph"):
+                assert self.config.database
+                go_to_database(self.browser, self.config.database)
+                state = _wait_graph_loaded(self.browser, self.config)
+            if state != "signin":
+                return self.browser
+            logger.debug("Session expired, sign-in again")
+            _open_graph(self.browser, self.config, metrics)
+            return self.browser
+
+        # Register to always kill child process when the script close, to not have zombie
+        # process.
+        # TODO: is is still needed with Selenium?
+        if not self.config.debug:
+            atexit.register(_kill_child_process)
+
+        self.download_directory = Path(tempfile.mkdtemp(prefix="roam-to-git-downloads-"))
+        logger.debug("Creating browser")
+        with metrics.stage("start browser"):
+            self.browser = Browser(browser=self.config.browser,
+                                   headless=not self.config.gui,
+                                   debug=self.config.debug,
+                                   output_directory=self.download_directory,
+                                   profile_directory=self.config.profile_directory)
+        _open_graph(self.browser, self.config, metrics)
+        return self.browser
+
+    def close(self):
+        if self.browser is not None:
+            logger.debug("Closing browser")
+            browser, self.browser = self.browser, None
+            browser.close()
+            logger.debug("Closed browser")
+        if self.download_directory is not None:
+            shutil.rmtree(self.download_directory, ignore_errors=True)
+            self.download_directory = None
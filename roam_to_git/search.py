@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import argparse
+import re
+import sqlite3
+import sys
+from pathlib import Path
+from typing import Dict, List, Mapping, NamedTuple, Tuple
+
+from roam_to_git.formatter import NoteIndex
+
+# Version of the schema of the search index. Bump it when the indexed fields change, so that
+# the next update rebuilds the index.
+SEARCH_INDEX_VERSION = 1
+
+# The full text of the notes, with a rowid equal to the id of their file
+_SCHEMA = """
+DROP TABLE IF EXISTS notes;
+DROP TABLE IF EXISTS files;
+CREATE TABLE files (id INTEGER PRIMARY KEY, note TEXT UNIQUE NOT NULL, hash TEXT NOT NULL);
+CREATE VIRTUAL TABLE notes USING fts5(title, body, tags, attributes, tokenize='unicode61');
+"""
+# Weights of the columns in the ranking: a match in the title matters the most
+_RANK = "bm25(notes, 10.0, 1.0, 5.0, 2.0)"
+
+# Tags: #tag and #[[tag with spaces]]
+_TAG_REGEX = re.compile(r"#\[\[([^\]\n]+)\]\]|#([a-zA-Z-_0-9]+)")
+# Attributes, like '  - attribute:: value'
+_ATTRIBUTE_REGEX = re.compile(r"^ *- ((?:[^:\n]|:[^:\n])+)::(.*)$", flags=re.MULTILINE)
+
+
+class SearchResult(NamedTuple):
+    note: str  # File name of the markdown note
+    snippet: str  # Text around the matches, highlighted with **
+
+
+def get_note_fields(file_name: str, content: str) -> Tuple[str, str, str, str]:
+    """Return the title, the body, the tags and the attributes of a note, as indexed"""
+    title = file_name[:-len(".md")] if file_name.endswith(".md") else file_name
+    tags = [match.group(1) or match.group(2) for match in _TAG_REGEX.finditer(content)]
+    attributes = [f"{match.group(1)}: {match.group(2).strip()}"
+                  for match in _ATTRIBUTE_REGEX.finditer(content)]
+    return title, content, "\n".join(tags), "\n".join(attributes)
+
+
+def open_search_index(path: Path) -> sqlite3.Connection:
+    """Open the search index, and create it if it's missing or outdated"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(str(path))
+    version, = connection.execute("PRAGMA user_version").fetchone()
+    if version != SEARCH_INDEX_VERSION:
+        connection.executescript(_SCHEMA + f"PRAGMA user_version = {SEARCH_INDEX_VERSION};")
+    return connection
+
+
+def update_search_index(path: Path, contents: Mapping[str, str], index: NoteIndex
+                        ) -> Dict[str, int]:
+    """Index the notes whose hash changed since the last update, and remove the deleted notes.
+
+    The hashes come from the link graph, so only the notes to index are read from contents.
+
+    :return: the number of notes indexed, removed and unchanged.
+    """
+    counts = {"indexed": 0, "removed": 0, "unchanged": 0}
+    connection = open_search_index(path)
+    try:
+        with connection:  # A single transaction
+            files = {note: (file_id, content_hash) for file_id, note, content_hash
+                     in connection.execute("SELECT id, note, hash FROM files")}
+            for note in set(files) - set(index):
+                file_id, _ = files[note]
+                connection.execute("DELETE FROM notes WHERE rowid = ?", (file_id,))
+                connection.execute("DELETE FROM files WHERE id = ?", (file_id,))
+                counts["removed"] += 1
+            for note in sorted(index):
+                content_hash = index[note][0]
+                if note in files:
+                    file_id, previous_hash = files[note]
+                    if previous_hash == content_hash:
+                        counts["unchanged"] += 1
+                        continue
+                    connection.execute("DELETE FROM notes WHERE rowid = ?", (file_id,))
+                    connection.execute("UPDATE files SET hash = ? WHERE id = ?",
+                                       (content_hash, file_id))
+                else:
+                    file_id = connection.execute("INSERT INTO files (note, hash) VALUES (?, ?)",
+                                                 (note, content_hash)).lastrowid
+                connection.execute("INSERT INTO notes (rowid, title, body, tags, attributes) "
+                                   "VALUES (?, ?, ?, ?, ?)",
+                                   (file_id, *get_note_fields(note, contents[note])))
+                counts["indexed"] += 1
+    finally:
+        connection.close()
+    return counts
+
+
+def search_notes(path: Path, query: str, limit: int = 20) -> List[SearchResult]:
+    """Return the notes matching a query in the FTS5 syntax, the most relevant first.
+
+    https://www.sqlite.org/fts5.html#full_text_query_syntax
+    """
+    if not path.exists():
+        raise FileNotFoundError(f"No search index at {path}")
+    connection = sqlite3.connect(str(path))
+    try:
+        rows = connection.execute(
+            "SELECT files.note, snippet(notes, -1, '**', '**', '...', 16) "
+            "FROM notes JOIN files ON files.id = notes.rowid "
+            f"WHERE notes MATCH ? ORDER BY {_RANK} LIMIT ?", (query, limit))
+        return [SearchResult(note, " ".join(snippet.split())) for note, snippet in rows]
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the notes in an index built by "
+                                                 "roam-to-git --search-index.")
+    parser.add_argument("index", help="Path of the search index.")
+    parser.add_argument("query", nargs="+",
+                        help="Words to search, in the query syntax of SQLite FTS5, like "
+                             "'backup AND git', 'title:roam' or 'tags:book'.")
+    parser.add_argument("--limit", "-n", type=int, default=20,
+                        help="Maximum number of notes to show.")
+    args = parser.parse_args()
+
+    try:
+        results = search_notes(Path(args.index), " ".join(args.query), limit=args.limit)
+    except (FileNotFoundError, sqlite3.OperationalError) as e:
+        print(f"Impossible to search: {e}", file=sys.stderr)
+        sys.exit(1)
+    for result in results:
+        print(f"{result.note}: {result.snippet}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,34 @@
 #!/usr/bin/env python3
 import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+import zipfile
+from pathlib import Path
+from unittest import mock
+
+import git
 import mypy.api
 from typing import List
 
-from roam_to_git.formatter import extract_links, format_link, format_to_do
+from roam_to_git.formatter import extract_links, format_link, format_to_do, format_markdown, \
+    build_note_index, format_markdown_incremental, format_content, extract_note_links, \
+    read_markdown_directory, MarkdownDirectory, iter_format_markdown, get_back_link_graph, Link, \
+    NoteIndex, read_note_index, save_note_index, INDEX_VERSION
+import json
+
+from roam_to_git.fs import unzip_and_save_archive, DirectoryWriter, pretty_print_edn, \
+    dump_canonical_json, save_json_archive, commit_git_directory, is_push_due, \
+    push_git_repository, get_archive_members, reset_git_directory, walk_directory, save_files, \
+    read_archive_cache
+from roam_to_git.metrics import Metrics
+from roam_to_git.exporter import Exporter, LocalExporter
+from roam_to_git.scrapping import Browser, wait_for_download
+from roam_to_git.search import search_notes, update_search_index
 
 
 class TestFormatTodo(unittest.TestCase):
@@ -111,6 +135,753 @@ class TestExtractLinks(unittest.TestCase):
                          ["attrib", "attrib2"])
 
 
+class TestSinglePass(unittest.TestCase):
+    """Test that the single-pass scanner gives the same result as the regexes one after the
+    other, including when the tokens overlap"""
+    pieces = ["[[", "]]", "[", "]", "#", "a", "b", " ", "\n", "- ", "  - ", "::", ":",
+              "{{[[TODO]]}}", "{{[[DONE]]}}", "{{", "}}", "-", "_"]
+
+    def _random_strings(self, n=5000):
+        rng = random.Random(0)
+        for _ in range(n):
+            yield "".join(rng.choice(self.pieces) for _ in range(rng.randint(0, 14)))
+
+    def test_format_content(self):
+        for string in self._random_strings():
+            self.assertEqual(format_content(string, link_prefix="../"),
+                             format_link(format_to_do(string), link_prefix="../"), string)
+
+    def test_extract_note_links(self):
+        for string in self._random_strings():
+            self.assertEqual(sorted(extract_note_links(string)),
+                             sorted((m.group(1), m.start(), m.end())
+                                    for m in extract_links(string)), string)
+
+
+class TestFormatMarkdown(unittest.TestCase):
+    contents = {
+        "a.md": "- {{[[TODO]]}} call [[b]] about #c\n- attrib:: [[b]]\n",
+        "b.md": "- [[a]] and [[ns/d]]\n  - {{[[DONE]]}}  done [[a]]\n",
+        "ns/d.md": "- [[b]] #tag\n- key:with:colon:: value\n",
+        "c.md": "- weird [[x #y]] and - [[z]]:: w\n",
+        "key:with:colon.md": "",
+    }
+
+    def test_format_markdown(self):
+        self.assertEqual(format_markdown(self.contents), {
+            "a.md": "- [ ] call [b](<b.md>) about [c](<c.md>)\n"
+                    "- **[attrib](<attrib.md>):** [b](<b.md>)\n\n"
+                    "# Backlinks\n"
+                    "## [b](<b.md>)\n"
+                    "- [a](<a.md>)\n\n"
+                    "- [x] done [a](<a.md>)\n\n",
+            "b.md": "- [a](<a.md>) and [ns/d](<ns/d.md>)\n"
+                    "  - [x] done [a](<a.md>)\n\n"
+                    "# Backlinks\n"
+                    "## [a](<a.md>)\n"
+                    "- [ ] call [b](<b.md>)\n\n"
+                    "- **[attrib](<attrib.md>):** [b](<b.md>)\n\n"
+                    "## [ns/d](<ns/d.md>)\n"
+                    "- [b](<b.md>)\n\n",
+            "ns/d.md": "- [b](<../b.md>) [tag](<../tag.md>)\n"
+                       "- **[key:with:colon](<../key:with:colon.md>):** value\n\n"
+                       "# Backlinks\n"
+                       "## [b](<b.md>)\n"
+                       "- [a](<../a.md>) and [ns/d](<../ns/d.md>)\n\n",
+            "c.md": "- **[weird [x [y](<y.md>)](<x [y](<y.md>).md>) and - [z](<z.md>)]"
+                    "(<weird [x [y](<y.md>)](<x [y](<y.md>).md>) and - [z](<z.md>).md>):** w\n",
+            "key:with:colon.md": "\n# Backlinks\n"
+                                 "## [ns/d](<ns/d.md>)\n"
+                                 "- [b](<b.md>) [tag](<tag.md>)\n"
+                                 "- **[key:with:colon](<key:with:colon.md>):**\n\n",
+        })
+
+    def test_link_at_the_end(self):
+        self.assertEqual(format_markdown({"a.md": "- see [[b]]", "b.md": ""}), {
+            "a.md": "- see [b](<b.md>)",
+            "b.md": "\n# Backlinks\n## [a](<a.md>)\n- see [b](<b.md>)\n\n",
+        })
+
+    def test_jobs(self):
+        self.assertEqual(list(format_markdown(self.contents, jobs=2).items()),
+                         list(format_markdown(self.contents).items()))
+
+    def test_low_memory(self):
+        for jobs in [1, 2]:
+            self.assertEqual(list(iter_format_markdown(self.contents, jobs=jobs,
+                                                       low_memory=True)),
+                             list(format_markdown(self.contents).items()))
+
+    def test_memory_map(self):
+        contents = dict(self.contents)
+        contents["émoji.md"] = "- 😀 [[a]]é and [[ü]]\n- ö:: [[b]] #c 日本\n- [[a]]\u3000"
+        # Mapped in memory instead of read
+        contents["large.md"] = "- lorem ipsum 😀 dolor\n" * 12000 + "- [[a]] #b\n"
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory)
+            save_files("markdown", path, contents)
+            (path / "crlf.md").write_bytes("- [[a]] é\r\n- b:: c\r\n".encode())
+            for low_memory in [False, True]:
+                for jobs in [1, 2]:
+                    index: NoteIndex = {}
+                    expected_index: NoteIndex = {}
+                    expected = list(iter_format_markdown(MarkdownDirectory(path), jobs=jobs,
+                                                         index=expected_index,
+                                                         low_memory=low_memory))
+                    self.assertEqual(list(iter_format_markdown(
+                        MarkdownDirectory(path), jobs=jobs, index=index, low_memory=low_memory,
+                        memory_map=True)), expected)
+                    self.assertEqual(index, expected_index)
+        with self.assertRaises(TypeError):
+            list(iter_format_markdown(contents, memory_map=True))
+
+
+class TestFormatMarkdownIncremental(unittest.TestCase):
+    """Test that formatting only the changed notes gives the same result as formatting all"""
+    contents = {
+        "a.md": "- link to [[b]]\n",
+        "b.md": "- attrib:: value\n",
+        "c.md": "- link to [[a]]\n",
+        "attrib.md": "- standalone\n",
+    }
+
+    def _check(self, new_contents, expected_formatted, expected_removed):
+        index = build_note_index(self.contents)
+        formatted, removed, new_index = format_markdown_incremental(new_contents, index)
+        full = format_markdown(new_contents)
+        self.assertEqual(sorted(formatted), expected_formatted)
+        self.assertEqual(removed, expected_removed)
+        self.assertEqual(formatted, {k: full[k] for k in expected_formatted})
+        self.assertEqual(new_index, build_note_index(new_contents))
+
+    def test_no_change(self):
+        self._check(self.contents, [], [])
+
+    def test_change_without_link(self):
+        self._check({**self.contents, "attrib.md": "- other\n"}, ["attrib.md"], [])
+
+    def test_change_with_link(self):
+        self._check({**self.contents, "a.md": "- link to [[b]] again\n"}, ["a.md", "b.md"], [])
+
+    def test_remove_link(self):
+        self._check({**self.contents, "b.md": "- value\n"}, ["attrib.md", "b.md"], [])
+
+    def test_remove_note(self):
+        contents = dict(self.contents)
+        del contents["c.md"]
+        self._check(contents, ["a.md"], ["c.md"])
+
+    def test_link_graph(self):
+        index: NoteIndex = {}
+        formatted = dict(iter_format_markdown(self.contents, index=index))
+        self.assertEqual(formatted, format_markdown(self.contents))
+        self.assertEqual(index, build_note_index(self.contents))
+        self.assertEqual(index["a.md"][1], [Link("b", 10, 15)])
+        self.assertEqual(get_back_link_graph(index)["b.md"], [("a.md", 10)])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "links.jsonl"
+            save_note_index(path, index)
+            self.assertEqual(read_note_index(path), index)
+            self.assertEqual(os.listdir(directory), ["links.jsonl"])
+            # Truncated by an interrupted run
+            path.write_text(path.read_text()[:-10])
+            self.assertIsNone(read_note_index(path))
+            path.write_text('{"version": 1}\n')
+            self.assertIsNone(read_note_index(path))
+
+
+class TestArchive(unittest.TestCase):
+    contents = {"a.md": "- [[ns/b]]\n", "ns/b.md": "- b\n"}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        (self.path / "zip").mkdir()
+        with zipfile.ZipFile(self.path / "zip" / "archive.zip", "w") as zip_file:
+            zip_file.writestr("ns/", "")
+            for file_name, content in self.contents.items():
+                zip_file.writestr(file_name, content)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_unzip_and_save_archive(self):
+        unzip_and_save_archive("markdown", self.path / "zip",
+                               DirectoryWriter(self.path / "markdown"))
+        self.assertEqual((self.path / "markdown" / "ns" / "b.md").read_text(), "- b\n")
+        self.assertEqual(read_markdown_directory(self.path / "markdown"), self.contents)
+
+    def test_markdown_directory(self):
+        unzip_and_save_archive("markdown", self.path / "zip",
+                               DirectoryWriter(self.path / "markdown"))
+        contents = MarkdownDirectory(self.path / "markdown", cache_size=1)
+        self.assertEqual(sorted(contents), sorted(self.contents))
+        self.assertEqual(dict(contents), self.contents)
+        # Only the last note read is kept in memory
+        self.assertEqual(list(contents._cache), [list(contents)[-1]])
+        (self.path / "markdown" / "a.md").write_text("changed")
+        self.assertEqual(contents["a.md"], "changed")
+
+    def test_changed_members(self):
+        unzip_and_save_archive("markdown", self.path / "zip",
+                               DirectoryWriter(self.path / "markdown"))
+        previous_members = get_archive_members(self.path / "zip")
+        self.assertEqual(sorted(previous_members), ["a.md", "ns/b.md"])
+
+        with zipfile.ZipFile(self.path / "zip" / "archive.zip", "w") as zip_file:
+            zip_file.writestr("a.md", "- [[ns/b]]\n")
+            zip_file.writestr("c.md", "- c\n")
+        writer = DirectoryWriter(self.path / "markdown")
+        unzip_and_save_archive("markdown", self.path / "zip", writer, previous_members)
+        # a.md didn't change, so it isn't even unzipped
+        self.assertEqual((writer.added, writer.changed, writer.removed, writer.unchanged),
+                         (1, 0, 1, 0))
+        self.assertEqual(read_markdown_directory(self.path / "markdown"),
+                         {"a.md": "- [[ns/b]]\n", "c.md": "- c\n"})
+
+
+class TestDirectoryWriter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        for file_name in ["same.md", "changed.md", "old.md", "old/child.md", ".git/HEAD"]:
+            (self.path / file_name).parent.mkdir(parents=True, exist_ok=True)
+            (self.path / file_name).write_text("content")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_sync(self):
+        writer = DirectoryWriter(self.path)
+        writer.save("markdown", "same.md", "content")
+        writer.save("markdown", "changed.md", "new content")
+        writer.save("markdown", "new/child.md", "content")
+        writer.remove_missing()
+        self.assertEqual((writer.added, writer.changed, writer.removed, writer.unchanged),
+                         (1, 1, 2, 1))
+        self.assertEqual(sorted(f.relative_to(self.path).as_posix()
+                                for f in self.path.glob("**/*") if f.is_file()),
+                         [".git/HEAD", "changed.md", "new/child.md", "same.md"])
+        self.assertEqual((self.path / "changed.md").read_text(), "new content")
+
+    def test_remove(self):
+        writer = DirectoryWriter(self.path)
+        writer.remove("old/child.md")
+        writer.remove("missing.md")
+        self.assertEqual(writer.removed, 1)
+        self.assertFalse((self.path / "old").exists())
+
+    def test_workers(self):
+        contents = {f"dir{i % 7}/page{i}.md": f"content {i}" for i in range(100)}
+        trees = []
+        for workers in [1, 4]:
+            path = self.path / f"workers{workers}"
+            writer = DirectoryWriter(path, workers=workers)
+            for file_name, content in contents.items():
+                writer.save("markdown", file_name, content)
+            writer.save("markdown", "dir0/page0.md", "content 0")
+            writer.remove_missing()
+            self.assertEqual(writer.get_counts()["added"], 100)
+            writer.close()
+            trees.append({f.relative_to(path).as_posix(): f.read_text()
+                          for f in path.glob("**/*") if f.is_file()})
+        self.assertEqual(trees[0], trees[1])
+
+    def test_workers_error(self):
+        writer = DirectoryWriter(self.path, workers=2)
+        writer.save("markdown", "new.md", "content")
+        writer.save("markdown", "old", "content")  # A directory
+        with self.assertRaises(IsADirectoryError):
+            writer.close()
+        self.assertEqual(writer.added, 1)
+
+
+class TestWalkDirectory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        for file_name in ["a.md", "b/c.md", "b/d/e.md", ".git/HEAD", "f/.git"]:
+            (self.path / file_name).parent.mkdir(parents=True, exist_ok=True)
+            (self.path / file_name).write_text("content")
+        (self.path / "empty").mkdir()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_walk(self):
+        names = [name for name, _ in walk_directory(self.path)]
+        self.assertEqual(sorted(names), ["a.md", "b", "b/c.md", "b/d", "b/d/e.md", "empty", "f"])
+        # The directories are yielded before their content
+        self.assertLess(names.index("b"), names.index("b/d"))
+        self.assertLess(names.index("b/d"), names.index("b/d/e.md"))
+
+    def test_reset(self):
+        reset_git_directory(self.path)
+        self.assertEqual(sorted(f.relative_to(self.path).as_posix()
+                                for f in self.path.glob("**/*")),
+                         [".git", ".git/HEAD", "f", "f/.git"])
+
+
+class TestCommit(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        self.repo = git.Repo.init(self.path)
+        with self.repo.config_writer() as config:
+            config.set_value("user", "name", "test")
+            config.set_value("user", "email", "test@example.com")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _commit(self, files):
+        writer = DirectoryWriter(self.path / "markdown")
+        for file_name, content in files.items():
+            writer.save_text(file_name, content)
+        writer.remove_missing()
+        commit_git_directory(self.repo, [writer.directory])
+
+    def _committed_files(self):
+        return sorted(item.path for item in self.repo.head.commit.tree.traverse()
+                      if item.type == "blob")
+
+    def test_only_given_directories(self):
+        (self.path / "untracked.md").write_text("not from roam-to-git")
+        self._commit({"a.md": "a", "b/c.md": "c"})
+        self.assertEqual(self._committed_files(), ["markdown/a.md", "markdown/b/c.md"])
+        self.assertIn("untracked.md", self.repo.untracked_files)
+
+    def test_removed_files(self):
+        self._commit({"a.md": "a", "b/c.md": "c"})
+        self._commit({"a.md": "a2"})
+        self.assertEqual(self._committed_files(), ["markdown/a.md"])
+        self.assertEqual(self.repo.head.commit.tree["markdown/a.md"].data_stream.read(), b"a2")
+        self.assertEqual(len(list(self.repo.iter_commits())), 2)
+        self.assertFalse(self.repo.is_dirty())
+
+    def test_no_change(self):
+        self._commit({"a.md": "a"})
+        commit = self.repo.head.commit
+        self._commit({"a.md": "a"})
+        self.assertEqual(self.repo.head.commit, commit)
+        # Written again with the committed content
+        (self.path / "markdown" / "a.md").write_text("changed")
+        self._commit({"a.md": "a"})
+        self.assertEqual(self.repo.head.commit, commit)
+
+    def test_changes_of_failed_run(self):
+        self._commit({"a.md": "a"})
+        # Written by a run that failed before its commit
+        (self.path / "markdown" / "b.md").write_text("b")
+        (self.path / "markdown" / "a.md").unlink()
+        commit_git_directory(self.repo, [self.path / "markdown"])
+        self.assertEqual(self._committed_files(), ["markdown/b.md"])
+
+    def test_pattern_characters(self):
+        self._commit({"p[1].md": "p", "p1.md": "p"})
+        self.assertEqual(self._committed_files(), ["markdown/p1.md", "markdown/p[1].md"])
+        (self.path / "markdown" / "p1.md").write_text("changed")
+        commit_git_directory(self.repo, [self.path / "markdown" / "p[1].md"])
+        self.assertIn("markdown/p1.md", [item.a_path for item in self.repo.index.diff(None)])
+
+    def test_ignored_and_untracked_paths(self):
+        (self.path / ".gitignore").write_text("ignored/\n")
+        (self.path / "ignored").mkdir()
+        (self.path / "ignored" / "a.md").write_text("a")
+        self._commit({"a.md": "a"})
+        commit_git_directory(self.repo, [self.path / "ignored", self.path / "removed.md",
+                                         self.path / "markdown"])
+        self.assertEqual(self._committed_files(), ["markdown/a.md"])
+
+    def test_no_identity(self):
+        with tempfile.TemporaryDirectory() as home:
+            environ = {name: value for name, value in os.environ.items()
+                       if not name.startswith(("GIT_", "EMAIL"))}
+            environ.update({"HOME": home, "XDG_CONFIG_HOME": home, "GIT_CONFIG_NOSYSTEM": "1"})
+            with mock.patch.dict(os.environ, environ, clear=True):
+                repo = git.Repo.init(self.path / "no-identity")
+                (self.path / "no-identity" / "markdown").mkdir()
+                (self.path / "no-identity" / "markdown" / "a.md").write_text("a")
+                commit_git_directory(repo, [self.path / "no-identity" / "markdown"])
+                self.assertEqual(repo.head.commit.tree["markdown/a.md"].data_stream.read(),
+                                 b"a")
+
+
+class TestBackup(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        with zipfile.ZipFile(self.path / "markdown.zip", "w") as zip_file:
+            zip_file.writestr("a.md", "- [[b]]")
+        self.notes = self.path / "notes"
+        self.repo = git.Repo.init(self.notes)
+        with self.repo.config_writer() as config:
+            config.set_value("user", "name", "test")
+            config.set_value("user", "email", "test@example.com")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _backup(self, *args):
+        subprocess.run([sys.executable, "-m", "roam_to_git", str(self.notes), "--skip-push",
+                        "--from-archive", str(self.path / "markdown.zip"),
+                        "-f", "markdown", "formatted", *args],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def test_stale_pages(self):
+        (self.notes / "markdown").mkdir()
+        (self.notes / "markdown" / "deleted.md").write_text("deleted in Roam")
+        self._backup("--skip-git")
+        self.assertEqual(sorted(os.listdir(self.notes / "markdown")), ["a.md"])
+        self.assertEqual(sorted(os.listdir(self.notes / "formatted")), ["a.md"])
+
+    def test_archive_cache(self):
+        self._backup()
+        commit = self.repo.head.commit
+        cache_path = self.notes / ".roam-to-git" / "archives.json"
+        self.assertEqual(read_archive_cache(cache_path, INDEX_VERSION, self.repo),
+                         {"markdown": get_archive_members(self.notes / "markdown")})
+        self.assertIn(".roam-to-git/archives.json",
+                      [item.path for item in commit.tree.traverse()])
+        self.assertFalse(self.repo.is_dirty(untracked_files=True))
+        # Only valid for the same formatting
+        self.assertEqual(read_archive_cache(cache_path, INDEX_VERSION + 1, self.repo), {})
+
+        (self.notes / "formatted" / "a.md").write_text("changed")
+        self._backup()
+        # The archive didn't change, so the notes were not formatted again, nor committed
+        self.assertEqual((self.notes / "formatted" / "a.md").read_text(), "changed")
+        self.assertEqual(self.repo.head.commit, commit)
+
+    def test_archive_cache_not_committed(self):
+        self._backup()
+        cache_path = self.notes / ".roam-to-git" / "archives.json"
+        # Saved by a run that failed before its commit
+        cache_path.write_text(cache_path.read_text().replace("markdown", "other"))
+        self.assertEqual(read_archive_cache(cache_path, INDEX_VERSION, self.repo), {})
+        self.assertEqual(read_archive_cache(cache_path, INDEX_VERSION),
+                         {"other": get_archive_members(self.notes / "markdown")})
+
+
+class TestPush(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        self.remote = git.Repo.init(self.path / "remote.git", bare=True)
+        # The history of the remote isn't fully cloned
+        init = git.Repo.clone_from(self.remote.git_dir, self.path / "init")
+        for content in ["a", "b"]:
+            self._commit(init, content)
+            init.git.push("origin", "HEAD:master")
+        self.repo = git.Repo.clone_from(f"file://{self.remote.git_dir}", self.path / "notes",
+                                        depth=1)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _commit(self, repo: git.Repo, content: str):
+        with repo.config_writer() as config:
+            config.set_value("user", "name", "test")
+            config.set_value("user", "email", "test@example.com")
+        path = Path(repo.working_tree_dir or "") / "a.md"
+        path.write_text(content)
+        commit_git_directory(repo, [path])
+
+    def test_shallow_clone(self):
+        self.assertEqual(len(list(self.repo.iter_commits())), 1)
+        self.assertFalse(is_push_due(self.repo))
+        self._commit(self.repo, "c")
+        self.assertTrue(is_push_due(self.repo))
+        push_git_repository(self.repo)
+        self.assertFalse(is_push_due(self.repo))
+        self.assertEqual(self.remote.commit("master"), self.repo.head.commit)
+
+    def test_push_every(self):
+        self._commit(self.repo, "c")
+        self.assertFalse(is_push_due(self.repo, push_every=2))
+        self.assertFalse(is_push_due(self.repo, push_every=2, push_interval=3600))
+        self.assertTrue(is_push_due(self.repo, push_every=2, push_interval=0))
+        self._commit(self.repo, "d")
+        self.assertTrue(is_push_due(self.repo, push_every=2))
+
+    def test_retry(self):
+        self._commit(self.repo, "c")
+        self.repo.remote("origin").set_url(str(self.path / "missing.git"))
+        with self.assertRaises(git.GitCommandError):
+            push_git_repository(self.repo, retries=2, backoff=0.)
+
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name) / "search.sqlite"
+        self.contents = {"Roam Research.md": "- A tool for #networked thought",
+                         "books/Dune.md": "- author:: Frank Herbert\n- #[[science fiction]]",
+                         "empty.md": ""}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def search(self, query: str) -> List[str]:
+        return [result.note for result in search_notes(self.path, query)]
+
+    def test_search(self):
+        counts = update_search_index(self.path, self.contents, build_note_index(self.contents))
+        self.assertEqual(counts, {"indexed": 3, "removed": 0, "unchanged": 0})
+        self.assertEqual(self.search("roam"), ["Roam Research.md"])
+        self.assertEqual(self.search("tags:networked"), ["Roam Research.md"])
+        self.assertEqual(self.search('tags:"science fiction"'), ["books/Dune.md"])
+        self.assertEqual(self.search("attributes:herbert"), ["books/Dune.md"])
+        self.assertEqual(self.search("title:dune OR thought"),
+                         ["books/Dune.md", "Roam Research.md"])
+        result, = search_notes(self.path, "herbert")
+        self.assertEqual(result.snippet, "- author:: Frank **Herbert** - #[[science fiction]]")
+
+    def test_incremental(self):
+        update_search_index(self.path, self.contents, build_note_index(self.contents))
+        contents = {"Roam Research.md": "- A tool for #networked thought",
+                    "books/Dune.md": "- author:: Frank Herbert\n- Arrakis"}
+        index = build_note_index(contents)
+        # Only the changed notes are read
+        changed = {"books/Dune.md": contents["books/Dune.md"]}
+        counts = update_search_index(self.path, changed, index)
+        self.assertEqual(counts, {"indexed": 1, "removed": 1, "unchanged": 1})
+        self.assertEqual(self.search("arrakis"), ["books/Dune.md"])
+        self.assertEqual(self.search("fiction"), [])
+
+
+class TestJson(unittest.TestCase):
+    pages = [
+        {"title": "a", "children": [{"string": "é [[b]]", "uid": "x", "open": True,
+                                     "heading": None, "refs": [], "props": {}}],
+         "edit-time": 1600000000000, "score": 1.5},
+        {"title": "ns/b", "create-email": "me@example.com"},
+        {"title": "ns/../b", "create-email": "me@example.com"},
+    ]
+
+    def test_dump_canonical_json(self):
+        for value in [self.pages, {}, [], "", 1, {"b": 1, "a": [[], {}, False]}, {1: 2}]:
+            self.assertEqual(dump_canonical_json(value),
+                             json.dumps(value, sort_keys=True, indent=2, ensure_ascii=True))
+
+    def test_save_json_archive(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory)
+            (path / "zip").mkdir()
+            with zipfile.ZipFile(path / "zip" / "archive.zip", "w") as zip_file:
+                zip_file.writestr("graph.json", json.dumps(self.pages))
+            writer = DirectoryWriter(path / "json")
+            save_json_archive(path / "zip", writer)
+            self.assertEqual(sorted(f.relative_to(path / "json").as_posix()
+                                    for f in (path / "json").glob("**/*") if f.is_file()),
+                             ["a.json", "ns/b (2).json", "ns/b.json"])
+            self.assertEqual(json.loads((path / "json" / "a.json").read_text()), self.pages[0])
+
+    def test_case_duplicates(self):
+        pages = [{"title": "Foo", "uid": "z"}, {"title": "foo", "uid": "a"},
+                 {"title": "foo (2)", "uid": "b"}]
+        for order in [pages, pages[::-1]]:
+            with tempfile.TemporaryDirectory() as directory:
+                path = Path(directory)
+                (path / "zip").mkdir()
+                with zipfile.ZipFile(path / "zip" / "archive.zip", "w") as zip_file:
+                    zip_file.writestr("graph.json", json.dumps(order))
+                writer = DirectoryWriter(path / "json")
+                save_json_archive(path / "zip", writer)
+                writer.remove_missing()
+                # Numbered by uid, whatever the order of the export
+                self.assertEqual({f.name: json.loads(f.read_text())["uid"]
+                                  for f in (path / "json").iterdir()},
+                                 {"foo.json": "a", "foo (2).json": "b", "Foo (3).json": "z"})
+
+
+@unittest.skipIf(os.name == "nt", "The fake jet is a shell script")
+class TestPrettyPrintEdn(unittest.TestCase):
+    documents = ["{:a 1}", "[1 2]"]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.environ["PATH"]
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        self.directory.cleanup()
+
+    def _install_jet(self, script: str):
+        jet = Path(self.directory.name) / "jet"
+        jet.write_text(f"#!/bin/sh\n{script}\n")
+        jet.chmod(0o755)
+        os.environ["PATH"] = f"{self.directory.name}{os.pathsep}{self.path}"
+
+    def test_no_jet(self):
+        os.environ["PATH"] = self.directory.name
+        self.assertEqual(pretty_print_edn(self.documents), self.documents)
+
+    def test_single_process(self):
+        # Count the number of times jet is started
+        self._install_jet(f"echo >> {self.directory.name}/calls; cat")
+        self.assertEqual(pretty_print_edn(self.documents), [d + "\n" for d in self.documents])
+        self.assertEqual((Path(self.directory.name) / "calls").read_text(), "\n")
+
+    def test_failure(self):
+        self._install_jet("echo error; exit 1")
+        self.assertEqual(pretty_print_edn(self.documents), self.documents)
+
+
+class TestWaitForDownload(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        self.previous = self.path / "previous.zip"
+        with zipfile.ZipFile(self.previous, "w") as zip_file:
+            zip_file.writestr("a.md", "a")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _wait(self, timeout=.5) -> Path:
+        return wait_for_download(self.path, "markdown", {self.previous}, timeout=timeout,
+                                 poll_interval=.01)
+
+    def test_complete(self):
+        self.previous.rename(self.path / "new.zip")
+        self.assertEqual(self._wait(), self.path / "new.zip")
+
+    def test_ignore_previous_files(self):
+        with self.assertRaises(FileNotFoundError):
+            self._wait(timeout=.05)
+
+    def test_in_progress(self):
+        # Firefox creates the final file empty, and writes the content in a .part file
+        (self.path / "new.zip").touch()
+        (self.path / "new.zip.part").write_bytes(self.previous.read_bytes())
+        with self.assertRaises(FileNotFoundError):
+            self._wait(timeout=.05)
+        (self.path / "new.zip.part").replace(self.path / "new.zip")
+        self.assertEqual(self._wait(), self.path / "new.zip")
+
+
+class TestBrowser(unittest.TestCase):
+    def test_debug_element(self):
+        # The debug mode checks the elements, and still wraps them
+        browser = Browser.__new__(Browser)
+        browser.debug = True
+        browser.browser = mock.Mock()
+        element = browser.find_element_by_css_selector("input[name='password']")
+        self.assertIs(element.html_element,
+                      browser.browser.find_element_by_css_selector.return_value)
+
+
+class TestLocalExporter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        self.markdown = self.path / "markdown.zip"
+        with zipfile.ZipFile(self.markdown, "w") as zip_file:
+            zip_file.writestr("a.md", "- a")
+        self.json = self.path / "graph.json"
+        self.json.write_text("[]")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_export(self):
+        exporter = LocalExporter([self.json, self.markdown])
+        (self.path / "zip").mkdir()
+        exporter.export(self.path / "zip", ["markdown", "json"])
+        with zipfile.ZipFile(self.path / "zip" / "markdown" / "markdown.zip") as zip_file:
+            self.assertEqual(zip_file.read("a.md"), b"- a")
+        with zipfile.ZipFile(self.path / "zip" / "json" / "graph.zip") as zip_file:
+            self.assertEqual(zip_file.read("graph.json"), b"[]")
+
+    def test_missing_format(self):
+        exporter = LocalExporter([self.markdown])
+        (self.path / "zip").mkdir()
+        with self.assertRaises(FileNotFoundError):
+            exporter.export(self.path / "zip", ["markdown", "json"])
+
+    def test_duplicated_format(self):
+        with self.assertRaises(ValueError):
+            LocalExporter([self.markdown, self.markdown])
+
+    def test_missing_export(self):
+        class IncompleteExporter(Exporter):
+            pass
+
+        with self.assertRaises(TypeError):
+            IncompleteExporter()  # type: ignore
+
+
+@unittest.skipIf(os.name == "nt", "SIGTERM can't be handled on Windows")
+class TestDaemon(unittest.TestCase):
+    def test_graceful_shutdown(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory)
+            with zipfile.ZipFile(path / "markdown.zip", "w") as zip_file:
+                zip_file.writestr("a.md", "- [[b]]")
+            process = subprocess.Popen(
+                [sys.executable, "-m", "roam_to_git", str(path / "notes"), "--skip-git",
+                 "--daemon", "--interval", "0.1", "--from-archive", str(path / "markdown.zip"),
+                 "-f", "markdown", "formatted"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                for _ in range(200):
+                    if (path / "notes" / "formatted" / "a.md").exists():
+                        break
+                    time.sleep(.05)
+                process.send_signal(signal.SIGTERM)
+                self.assertEqual(process.wait(timeout=30), 0)
+            finally:
+                process.kill()
+            self.assertEqual((path / "notes" / "formatted" / "a.md").read_text(),
+                             "- [b](<b.md>)")
+
+
+class TestImports(unittest.TestCase):
+    def test_formatting_only(self):
+        """Formatting the notes doesn't import the modules of the browser and of git"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory)
+            (path / "markdown").mkdir()
+            (path / "markdown" / "a.md").write_text("- [[b]]")
+            script = ("import sys\n"
+                      "from roam_to_git.__main__ import main\n"
+                      "main()\n"
+                      "print([m for m in ('git', 'selenium', 'psutil', 'pdb') "
+                      "if m in sys.modules])\n")
+            output = subprocess.run(
+                [sys.executable, "-c", script, str(path), "--skip-git", "-f", "formatted"],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+            self.assertEqual(output.stdout.decode().strip(), "[]")
+            self.assertEqual((path / "formatted" / "a.md").read_text(), "- [b](<b.md>)")
+
+
+class TestMetrics(unittest.TestCase):
+    def test_stages(self):
+        metrics = Metrics()
+        for name in ["export markdown", "export json", "export markdown"]:
+            with metrics.stage(name) as stage:
+                stage.counts["notes"] += 2
+        report = metrics.to_json()
+        self.assertEqual([stage["name"] for stage in report["stages"]],
+                         ["export markdown", "export json", "export markdown"])
+        self.assertGreater(report["peak_rss"], 0)
+
+        # The stages with the same name are aggregated for Prometheus
+        lines = metrics.to_prometheus().splitlines()
+        self.assertIn('roam_to_git_stage_items{stage="export markdown",item="notes"} 4', lines)
+        durations = [line for line in lines
+                     if line.startswith("roam_to_git_stage_duration_seconds{")]
+        self.assertEqual(len(durations), 2)
+
+    def test_label_escaping(self):
+        metrics = Metrics()
+        with metrics.stage('say "hi"'):
+            pass
+        self.assertIn('{stage="say \\"hi\\""}', metrics.to_prometheus())
+
+
 class TestMypy(unittest.TestCase):
     def _test_mypy(self, files: List[str]):
         stdout, stderr, exit_status = mypy.api.run(["--ignore-missing-imports", *files])